@@ -1,9 +1,26 @@
-import os         # For Windows stuff
+from concurrent.futures import ThreadPoolExecutor
+import getpass
 import json       # json library
 import requests   # See: http://docs.python-requests.org/en/master/
+from collections import OrderedDict
 from pprint import pprint
 import logging
 import sys
+import threading
+import time
+
+from tracing import Trace
+
+try:
+    import orjson     # Optional. Faster parsing of IMWS responses. pip3 install orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    import ijson      # Optional. Incremental parsing of large IMWS responses. pip3 install ijson
+except ImportError:
+    ijson = None
 
 logging.getLogger('urllib3').setLevel(logging.INFO) # Don't want this debug level to cloud ours
 
@@ -25,6 +42,34 @@ class IMatchUtility:
         """Given a list of items where one record in the field is ID, return the list of IDs"""
         return list(map(cls.getID, x))
     
+    @classmethod
+    def split_filelist(cls, filelist):
+        """The reverse of prepare_filelist(). Return the ids in a comma separated string as a list of ints"""
+        return [int(id) for id in str(filelist).split(",") if id.strip() != ""]
+
+    @classmethod
+    def items_at(cls, response, keys):
+        """Yield what an ijson prefix (split on '.') selects from an already parsed response"""
+        if len(keys) == 0:
+            yield response
+        elif keys[0] == "item":
+            for element in response:
+                yield from cls.items_at(element, keys[1:])
+        else:
+            yield from cls.items_at(response[keys[0]], keys[1:])
+
+    @classmethod
+    def chunk_filelist(cls, filelist, size):
+        """Split a list of ids into lists of at most size ids"""
+        return [filelist[start:start + size] for start in range(0, len(filelist), size)]
+
+    @classmethod
+    def single_id(cls, filelist):
+        """Return the id if filelist is a single id or a list of one, otherwise None"""
+        if isinstance(filelist, list):
+            return filelist[0] if len(filelist) == 1 else None
+        return filelist
+
     @classmethod
     def prepare_filelist(cls, filelist):
         """Accept an array of image ids, or a single id and format for an IMmatchAPI call"""
@@ -40,6 +85,21 @@ class IMatchUtility:
                 raise TypeError("Filelist argument must be single integer or list of integers.")      
     
 
+class IMatchError(Exception):
+    """IMatch refused a change. Raised rather than exiting so the caller can carry on with other files."""
+
+
+class RequestBatch:
+    """Single-id requests to the same endpoint, with the same parameters, waiting to go as one request"""
+
+    __slots__ = ('ids', 'responses', 'done')
+
+    def __init__(self) -> None:
+        self.ids = []
+        self.responses = {}     # id -> response as if the id had been requested alone
+        self.done = threading.Event()
+
+
 class IMatchAPI:
     """Connect to an active IMatch database. Implemented as a Singleton Design pattern."""
     COLLECTION_WRITE_BACK_PENDING = 5
@@ -59,6 +119,12 @@ class IMatchAPI:
     COLLECTION_PINS_BLUE = 53
     COLLECTION_PINS_NONE = 54
     REQUEST_TIMEOUT = 10                    # Request timeout in seconds
+    CACHE_TTL = 300                         # Seconds a cached get_imatch() response is reused for
+    CACHE_SIZE = 4096                       # Most responses to hold. Least recently used go first
+    COALESCE_WINDOW = 0.005                 # Seconds to wait for other single-id requests to join a batch
+    COALESCE_MAX = 100                      # Most ids in a coalesced request
+    CHUNK_SIZE = 500                        # Most ids in one request. Longer lists are split
+    CHUNK_WORKERS = 4                       # Chunks of a long list fetched at once
 
     __auth_token = None # This stores the IMWS authentication token after authenticate() has been called
     __host_url = None
@@ -79,6 +145,25 @@ class IMatchAPI:
         COLLECTION_PINS_NONE : "Pins|None",
         }   
 
+    # Read-through cache for get_imatch(). (endpoint, params) -> (expiry time, response).
+    # Responses are shared between callers so must be treated as read-only.
+    __cache = OrderedDict()
+    __cache_lock = threading.Lock()
+    cache_hits = 0
+    cache_misses = 0
+
+    # What requests are sent through. A cassette.Cassette when recording or replaying a run
+    transport = requests
+
+    # Requests actually made to IMatch. endpoint -> count
+    request_counts = {}
+    __request_counts_lock = threading.Lock()
+
+    # Single-id requests being coalesced. Key as for the cache, without the id -> RequestBatch
+    __batches = {}
+    __batch_lock = threading.Lock()
+    __coalescing = 0    # Callers currently in coalesced_get()
+
     def __init__(self, host_port=50519) -> None:
         """ Authenticate against IMWS and set the __auth_token variable
             to the returned authentication token. We need this for all other endpoints. """
@@ -90,8 +175,8 @@ class IMatchAPI:
 
             try:
                 print(f"IMatchAPI: Attempting connection to IMatch on port {host_port}")
-                req = requests.post(IMatchAPI.__host_url + '/v1/authenticate', params={
-                    'id': os.getlogin(),
+                req = IMatchAPI.transport.post(IMatchAPI.__host_url + '/v1/authenticate', params={
+                    'id': getpass.getuser(),
                     'password': '',
                     'appid': ''},
                     timeout=IMatchAPI.REQUEST_TIMEOUT)
@@ -117,21 +202,199 @@ class IMatchAPI:
                 print(ex)
                 sys.exit(1)
 
+    @classmethod
+    def cache_key(cls, endpoint, params):
+        """Key a request on its endpoint and parameters, ignoring the auth_token"""
+        return (endpoint, tuple(sorted((name, str(value)) for name, value in params.items() if name != 'auth_token')))
+
+    @classmethod
+    def cache_stats(cls):
+        return {
+            "hits" : cls.cache_hits,
+            "misses" : cls.cache_misses,
+            "entries" : len(cls.__cache),
+        }
+
+    @classmethod
+    def count_request(cls, endpoint):
+        with cls.__request_counts_lock:
+            cls.request_counts[endpoint] = cls.request_counts.get(endpoint, 0) + 1
+
+    @classmethod
+    def clear_cache(cls):
+        """Forget all cached responses, e.g. when IMatch may have been changed by someone else"""
+        with cls.__cache_lock:
+            cls.__cache.clear()
+
+    @classmethod
+    def invalidate_cache(cls, endpoint, params):
+        """Drop the cached responses a write to endpoint with params could have changed"""
+        ids = set(IMatchUtility.split_filelist(params.get('id', params.get('fileid', ''))))
+
+        def related_paths(a, b):
+            # One category contains the other, so the file lists of both are affected
+            return a == b or a.startswith(b + "|") or b.startswith(a + "|")
+
+        def affected(key):
+            cached_endpoint, cached_params = key
+            cached_params = dict(cached_params)
+            cached_ids = set(IMatchUtility.split_filelist(cached_params.get('id', '')))
+            match endpoint:
+                case '/v1/attributes':
+                    return cached_endpoint == '/v1/attributes' and cached_params.get('set') == params.get('set') and len(ids & cached_ids) > 0
+                case '/v1/categories/assign' | '/v1/categories/unassign':
+                    if cached_endpoint == '/v1/files/categories':
+                        return len(ids & cached_ids) > 0
+                    if cached_endpoint == '/v1/categories':
+                        return any(related_paths(path, params['path']) for path in cached_params.get('path', '').split(','))
+                    return False
+                case '/v1/collections':
+                    return cached_endpoint == '/v1/files/collections' and len(ids & cached_ids) > 0
+                case other:
+                    # Don't know what this write touches, so trust nothing
+                    return True
+
+        with cls.__cache_lock:
+            for key in [key for key in cls.__cache if affected(key)]:
+                del cls.__cache[key]
+
+    @classmethod
+    def cached_response(cls, key):
+        """Return the unexpired cached response for key, or None. Counts as a hit or miss."""
+        with cls.__cache_lock:
+            try:
+                expiry, response = cls.__cache[key]
+                if expiry > time.monotonic():
+                    cls.__cache.move_to_end(key)
+                    cls.cache_hits += 1
+                    return response
+                del cls.__cache[key]
+            except KeyError:
+                pass
+            cls.cache_misses += 1
+        return None
+
+    @classmethod
+    def cache_response(cls, key, response):
+        with cls.__cache_lock:
+            cls.__cache[key] = (time.monotonic() + cls.CACHE_TTL, response)
+            if len(cls.__cache) > cls.CACHE_SIZE:
+                cls.__cache.popitem(last=False)
+
+    @classmethod
+    def coalesced_get(cls, endpoint, params, id, list_key):
+        """ get_imatch() for a single id. When other threads are asking the same endpoint with the same
+         params for other ids at the same time, the ids go to IMatch as one request and the results
+         are handed back to each caller. list_key is the response list holding the per-id records. """
+
+        single_params = dict(params, id=str(id))
+        response = cls.cached_response(cls.cache_key(endpoint, single_params))
+        if response is not None:
+            return response
+
+        batch_params = {name : value for name, value in params.items() if name not in ('id', 'auth_token')}
+        batch_key = cls.cache_key(endpoint, batch_params)
+        with cls.__batch_lock:
+            cls.__coalescing += 1
+            batch = cls.__batches.get(batch_key)
+            leader = batch is None
+            if leader:
+                batch = RequestBatch()
+                cls.__batches[batch_key] = batch
+            if id not in batch.ids:
+                batch.ids.append(id)
+            if len(batch.ids) >= cls.COALESCE_MAX:
+                del cls.__batches[batch_key]    # Full. The next caller starts a new batch
+            others_waiting = cls.__coalescing > 1
+
+        try:
+            if not leader:
+                batch.done.wait()
+            else:
+                try:
+                    # Nobody else asking means nothing to wait for
+                    if others_waiting:
+                        time.sleep(cls.COALESCE_WINDOW)
+                    with cls.__batch_lock:
+                        if cls.__batches.get(batch_key) is batch:
+                            del cls.__batches[batch_key]
+                    logging.debug(f"Coalesced {len(batch.ids)} requests to {endpoint}")
+                    response = cls.get_imatch(endpoint, dict(batch_params, id=IMatchUtility.prepare_filelist(batch.ids)))
+                    if response is not None:
+                        records = {record['id'] : record for record in response[list_key]}
+                        for batch_id in batch.ids:
+                            batch.responses[batch_id] = {list_key : [records[batch_id]] if batch_id in records else []}
+                            cls.cache_response(cls.cache_key(endpoint, dict(batch_params, id=str(batch_id))), batch.responses[batch_id])
+                finally:
+                    batch.done.set()
+        finally:
+            with cls.__batch_lock:
+                cls.__coalescing -= 1
+
+        return batch.responses.get(id)
+
+    @classmethod
+    def fetch(cls, endpoint, params, filelist, list_key):
+        """ get_imatch() for a list of file ids. Single-id requests made at the same time are coalesced.
+         Lists longer than CHUNK_SIZE are fetched in chunks, in parallel, to keep within URL length
+         limits, and the records merged back in order. """
+        id = IMatchUtility.single_id(filelist)
+        if id is not None:
+            return cls.coalesced_get(endpoint, params, id, list_key)
+
+        if not isinstance(filelist, list):
+            filelist = IMatchUtility.split_filelist(filelist)
+        if len(filelist) <= cls.CHUNK_SIZE:
+            return cls.get_imatch(endpoint, dict(params, id=IMatchUtility.prepare_filelist(filelist)))
+
+        chunks = IMatchUtility.chunk_filelist(filelist, cls.CHUNK_SIZE)
+        logging.debug(f"Fetching {len(filelist)} ids from {endpoint} in {len(chunks)} chunks")
+        with ThreadPoolExecutor(max_workers=cls.CHUNK_WORKERS, thread_name_prefix="imatch-fetch") as fetchers:
+            responses = list(fetchers.map(
+                Trace.carry(lambda chunk: cls.get_imatch(endpoint, dict(params, id=IMatchUtility.prepare_filelist(chunk)))),
+                chunks
+                ))
+        if any(response is None for response in responses):
+            return None     # Error already logged by get_imatch
+        return {list_key : [record for response in responses for record in response[list_key]]}
+
+    @classmethod
+    def post_chunked(cls, endpoint, params, filelist, id_param):
+        """ post_imatch() for a list of file ids, in chunks of CHUNK_SIZE. Chunks are sent one after
+         the other so a failure stops the rest. Returns the last response. """
+        if not isinstance(filelist, list):
+            filelist = IMatchUtility.split_filelist(filelist)
+        response = None
+        for chunk in IMatchUtility.chunk_filelist(filelist, cls.CHUNK_SIZE):
+            response = cls.post_imatch(endpoint, dict(params, **{id_param : IMatchUtility.prepare_filelist(chunk)}))
+            if response is None or response['result'] != "ok":
+                break
+        return response
+
     @classmethod
     def get_imatch(cls, endpoint, params):
         """ Generic get function to IMatch. Other functions call this so there is no need for them to repeat
-         the main control loop. Ensures the auth_token is not missed as a parameter. """
-
-        params['auth_token'] = cls.__auth_token
+         the main control loop. Ensures the auth_token is not missed as a parameter. Responses are
+         cached for CACHE_TTL seconds until a post_imatch() changes what they cover. """
 
         # Easy to miss the leading / so add it as a courtesy
         if endpoint[:1] != "/":
             endpoint = "/" + endpoint
 
+        key = cls.cache_key(endpoint, params)
+        response = cls.cached_response(key)
+        if response is not None:
+            return response
+
+        params = dict(params, auth_token=cls.__auth_token)
+
         try:
-            req = requests.get(cls.__host_url + endpoint, params, timeout=cls.REQUEST_TIMEOUT)
-            response = json.loads(req.text)
+            cls.count_request(endpoint)
+            with Trace.span(endpoint, 'imatch'):
+                req = cls.transport.get(cls.__host_url + endpoint, params, timeout=cls.REQUEST_TIMEOUT)
+                response = json_loads(req.content)  # Parse the bytes. req.text would hold a decoded copy as well
             if req.status_code == requests.codes.ok:
+                cls.cache_response(key, response)
                 return response
             else:
                 req.raise_for_status()
@@ -141,18 +404,56 @@ class IMatchAPI:
         except Exception as ex:
             logging.error(ex)
 
+    @classmethod
+    def iter_imatch(cls, endpoint, params, prefix):
+        """ Generic streaming get function to IMatch. Yields the items of the response list at prefix
+         (ijson notation, e.g. 'files.item') as they are parsed from the byte stream, so large responses
+         are never held whole. Falls back to parsing the whole response if ijson is not installed.
+         Responses are not cached. Raises IMatchError if the request fails, as it can't return
+         None part way through. """
+
+        params = dict(params, auth_token=cls.__auth_token)
+
+        # Easy to miss the leading / so add it as a courtesy
+        if endpoint[:1] != "/":
+            endpoint = "/" + endpoint
+
+        try:
+            cls.count_request(endpoint)
+            # The span ends once the response has started (or, without ijson, been read), so it
+            # doesn't take in the time the caller spends on each item.
+            with Trace.span(endpoint, 'imatch'):
+                req = cls.transport.get(cls.__host_url + endpoint, params, timeout=cls.REQUEST_TIMEOUT, stream=True)
+                try:
+                    req.raise_for_status()
+                    response = None if ijson is not None else json_loads(req.content)
+                except BaseException:
+                    req.close()
+                    raise
+            with req:
+                if ijson is not None:
+                    req.raw.decode_content = True   # Undo any transfer compression before parsing
+                    yield from ijson.items(req.raw, prefix, use_float=True)
+                else:
+                    yield from IMatchUtility.items_at(response, prefix.split("."))
+        except requests.exceptions.RequestException as re:
+            raise IMatchError(f"Unable to get {endpoint}: {re}") from re
+
     @classmethod
     def post_imatch(cls, endpoint, params):
         """ Generic post function to IMatch. Other functions call this so there is no need for them to repeat
          the main control loop. Ensures the auth_token is not missed as a parameter. """
 
-        params['auth_token'] = cls.__auth_token
+        params = dict(params, auth_token=cls.__auth_token)
 
         # Easy to miss the leading / so add it as a courtesy
         if endpoint[:1] != "/":
             endpoint = "/" + endpoint
 
-        req = requests.post(cls.__host_url + endpoint, params, timeout=cls.REQUEST_TIMEOUT)
+        cls.count_request(endpoint)
+        with Trace.span(endpoint, 'imatch'):
+            req = cls.transport.post(cls.__host_url + endpoint, params, timeout=cls.REQUEST_TIMEOUT)
+        cls.invalidate_cache(endpoint, params)
         response = json.loads(req.text)
         if req.status_code == requests.codes.ok:
             return response
@@ -165,47 +466,47 @@ class IMatchAPI:
         """Assign files to category"""
         params = {}
         params['path'] = category
-        params['fileid'] = IMatchUtility().prepare_filelist(filelist)
 
         try:
-            response = cls.post_imatch( '/v1/categories/assign', params)
+            response = cls.post_chunked( '/v1/categories/assign', params, filelist, 'fileid')
             if response is not None:
                 if response['result'] == "ok":
                     logging.debug("Success")
                     return
             else:
-                print("There was an error removing images from the category. Please see message above.")
-                sys.exit()
+                raise IMatchError(f"Unable to assign files to {category}. Please see message above.")
         except requests.exceptions.RequestException as re:
-            print(re)
-            print(params)
-            sys.exit(1)
+            raise IMatchError(f"Unable to assign files to {category}: {re}") from re
 
     @classmethod
     def delete_attributes(cls, set, filelist, params={}, data={}):
         """ Delete attributes for image with id. Assumes attributes only exist once.
          (modification required if multiple instances of attribute sets are to be managed) """
 
-        params['set'] = set
-        params['id'] = IMatchUtility().prepare_filelist(filelist)
+        if not isinstance(filelist, list):
+            filelist = IMatchUtility.split_filelist(filelist)
+        attributes = cls.get_attributes_index(set, filelist)
 
-        tasks = [{
-            'op' : "delete",
-            'instanceid': [cls.get_attributes(set,filelist)[0]['instanceId']],
-        }]
+        # Each chunk of files is sent with the instances belonging to those files
+        for chunk in IMatchUtility.chunk_filelist(filelist, cls.CHUNK_SIZE):
+            tasks = [{
+                'op' : "delete",
+                'instanceid': [attributes[id]['instanceId'] for id in chunk if id in attributes],
+            }]
 
-        params['tasks'] = json.dumps(tasks)  # Necessary to stringify the tasks array before sending
+            chunk_params = dict(params, set=set, id=IMatchUtility.prepare_filelist(chunk))
+            chunk_params['tasks'] = json.dumps(tasks)  # Necessary to stringify the tasks array before sending
 
-        logging.debug(f"Sending instructions : {params}")
+            logging.debug(f"Sending instructions : {chunk_params}")
 
-        response = cls.post_imatch( '/v1/attributes', params)
+            response = cls.post_imatch( '/v1/attributes', chunk_params)
 
-        if response['result'] == "ok":
-            logging.debug("Success")
-        else:
-            logging.error("There was an error updating attributes.")
-            pprint(response)
-            sys.exit(1)
+            if response['result'] == "ok":
+                logging.debug("Success")
+            else:
+                logging.error("There was an error updating attributes.")
+                pprint(response)
+                raise IMatchError(f"Unable to delete {set} attributes.")
 
     @classmethod
     def get_application_variable(cls, variable):
@@ -220,11 +521,10 @@ class IMatchAPI:
     def get_attributes(cls, set, id, params={}):
         """ Return all attributes for a list of file ids. filelist is an array. """
 
-        params['set'] = set
-        params['id'] = IMatchUtility().prepare_filelist(id)
+        params = dict(params, set=set)
 
-        logging.debug(f"Retreivving attributes for {params['id']}")
-        response = cls.get_imatch( '/v1/attributes', params)
+        logging.debug(f"Retreivving attributes for {id}")
+        response = cls.fetch( '/v1/attributes', params, id, 'result')
 
         # Strip away the wrapping from the result
         results = []
@@ -233,11 +533,28 @@ class IMatchAPI:
         logging.debug(f"{len(results)} attribute instances retrieved.")
         return results
 
+    @classmethod
+    def get_attributes_index(cls, set, filelist, params={}):
+        """ Return the attributes for a list of file ids in one call, as a dict of file id -> attributes.
+         Files without attributes in the set are not included. """
+
+        params = dict(params, set=set)
+
+        logging.debug(f"Retrieving {set} attributes for {len(filelist)} files")
+        response = cls.fetch( '/v1/attributes', params, filelist, 'result')
+
+        results = {}
+        for attributes in response['result']:
+            if len(attributes['data']) > 0:
+                results[attributes['id']] = attributes['data'][0]
+        logging.debug(f"{len(results)} attribute instances retrieved.")
+        return results
+
     @classmethod
     def get_category_info(cls, category, params={}):
         """ Return information about a category"""
 
-        params['path'] = category
+        params = dict(params, path=category)
         
         logging.debug(f"Retreivving category information for {category}")
         response = cls.get_imatch( '/v1/categories', params)
@@ -247,9 +564,7 @@ class IMatchAPI:
     def get_file_categories(cls, filelist, params={}):
         """ Return the categories for the list of files """
 
-        params['id'] = IMatchUtility().prepare_filelist(filelist)
-
-        response = cls.get_imatch( '/v1/files/categories', params)
+        response = cls.fetch( '/v1/files/categories', params, filelist, 'files')
         results = {}
         for file in response['files']:
             logging.debug(file)
@@ -298,19 +613,26 @@ class IMatchAPI:
     def get_file_metadata(cls, filelist, params={}):
         """ Return details list of file ids """
 
-        params['id'] = IMatchUtility().prepare_filelist(filelist)
-        response = cls.get_imatch( '/v1/files', params)
+        response = cls.fetch( '/v1/files', params, filelist, 'files')
         return response['files']
     
+    @classmethod
+    def iter_file_metadata(cls, filelist, params={}):
+        """ Yield the details for a list of file ids one file at a time as the response arrives """
+
+        if not isinstance(filelist, list):
+            filelist = IMatchUtility.split_filelist(filelist)
+        for chunk in IMatchUtility.chunk_filelist(filelist, cls.CHUNK_SIZE):
+            yield from cls.iter_imatch( '/v1/files', dict(params, id=IMatchUtility.prepare_filelist(chunk)), 'files.item')
+
     @classmethod
     def get_master_id(cls, id):
         """ Return the number of the master if one exists """
 
         params = {}
-        params["id"] = id
         params["type"] = "masters"
 
-        response = cls.get_imatch( '/v1/files/relations', params)
+        response = cls.fetch( '/v1/files/relations', params, id, 'files')
 
         if len(response['files'][0]['masters']) == 1:
             return response['files'][0]['masters'][0]['files'][0]['id']
@@ -338,8 +660,8 @@ class IMatchAPI:
         """ Set attributes for image with id. Assumes attributes only exist once. Will either add or update as needed.
          (modification required if multiple instances of attribute sets are to be managed) """
 
-        params['set'] = set
-        params['id'] = IMatchUtility().prepare_filelist(filelist)
+        # A copy, so calls on different threads don't share the default
+        params = dict(params, set=set, id=IMatchUtility.prepare_filelist(filelist))
 
         # Can neither assume no attribute instance, or an existing attribute instance. 
         # Check first
@@ -354,11 +676,10 @@ class IMatchAPI:
                 'data' : data
             }]
         else:
-            op = 'update'
             logging.debug("Updating existing attribute row.")
             tasks = [{
-                'op' : "add",
-                'instanceid': [attributes['instanceId']],
+                'op' : "update",
+                'instanceid': [attributes[0]['instanceId']],
                 'data' : data
             }]
 
@@ -373,7 +694,7 @@ class IMatchAPI:
         else:
             logging.error("There was an error updating attributes.")
             pprint(response)
-            sys.exit()
+            raise IMatchError(f"Unable to set {set} attributes.")
 
     @classmethod
     def set_collections(cls, collection, filelist, op="add", params={}):
@@ -383,36 +704,31 @@ class IMatchAPI:
         else:
             path = collection
 
-        params['id'] = IMatchUtility().prepare_filelist(filelist)
-            
         tasks = [{
             'op' : op,
             'path' : path
         }]
 
-        params['tasks'] = json.dumps(tasks)  # Necessary to stringify the tasks array before sending
+        params = dict(params, tasks=json.dumps(tasks))  # Necessary to stringify the tasks array before sending
 
-        response = cls.post_imatch( '/v1/collections', params)
+        response = cls.post_chunked( '/v1/collections', params, filelist, 'id')
         if response is not None:
             if response['result'] == "ok":
                 logging.debug("Success")
                 return
         else:
-            print("There was an error updating the collection. Please see message above.")
-            sys.exit()
+            raise IMatchError(f"Unable to update collection {path}. Please see message above.")
 
     @classmethod
     def unassign_category(cls, category, filelist):
         """Remove files from category"""
         params = {}
         params['path'] = category
-        params['fileid'] = IMatchUtility().prepare_filelist(filelist)
 
-        response = cls.post_imatch( '/v1/categories/unassign', params)
+        response = cls.post_chunked( '/v1/categories/unassign', params, filelist, 'fileid')
         if response is not None:
             if response['result'] == "ok":
                 logging.debug("Success")
                 return
         else:
-            print("There was an error removing images from the category. Please see message above.")
-            sys.exit()
+            raise IMatchError(f"Unable to remove files from {category}. Please see message above.")
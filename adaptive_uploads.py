@@ -0,0 +1,114 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+import requests
+
+import config
+from outcomes import Outcome
+from tracing import Trace
+
+
+class AdaptiveUploader():
+    """Runs a platform's uploads on worker threads, adjusting how many run at once from what the link
+    achieves. After each window of uploads (one per upload slot) the number of slots goes up by one
+    if bytes/sec held up, down by one if it fell (the link is saturated), and is halved if any upload
+    errored or timed out (AIMD). Optionally paces uploads to stay under a bandwidth cap."""
+
+    def __init__(self, name, initial=None, maximum=None, bandwidth_cap=None) -> None:
+        self.name = name
+        self.maximum = config.UPLOAD_MAX_WORKERS if maximum is None else maximum
+        self.limit = min(self.maximum, config.UPLOAD_INITIAL_WORKERS if initial is None else initial)
+        self.bandwidth_cap = config.UPLOAD_BANDWIDTH_CAP if bandwidth_cap is None else bandwidth_cap
+        self.executor = ThreadPoolExecutor(max_workers=self.maximum, thread_name_prefix=f"{name}-upload")
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.futures = []
+        self.started = None             # When the first upload started
+        self.bytes_started = 0          # For pacing under the bandwidth cap
+        self.bytes_done = 0
+        self.uploads = 0
+        self.errors = 0
+        self.peak_limit = self.limit
+        self.window = []                # (bytes, ok) for uploads since the last adjustment
+        self.window_started = None
+        self.window_rate = None         # Bytes/sec achieved over the last window
+
+    def submit(self, function, image, *args, size=None):
+        """Run function(image, *args) on an upload thread once a slot is free. size is the bytes it
+        uploads, image.size unless given (0 for a step that uploads no media)."""
+        size = image.size if size is None else size
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+            if self.started is None:
+                self.started = time.monotonic()
+                self.window_started = self.started
+            self.bytes_started += size
+            delay = self.pacing_delay()
+        if delay > 0:
+            time.sleep(delay)
+        self.futures.append(self.executor.submit(Trace.carry(self.run), function, image, *args, size=size))
+
+    def pacing_delay(self) -> float:
+        """Seconds to hold back the next upload so the average rate stays under the cap"""
+        if not self.bandwidth_cap:
+            return 0
+        return self.bytes_started / self.bandwidth_cap - (time.monotonic() - self.started)
+
+    def run(self, function, image, *args, size):
+        ok = False
+        try:
+            result = function(image, *args)
+            ok = not isinstance(result, Outcome) or result.succeeded    # Controllers return failures rather than raise them
+            return result
+        except requests.exceptions.Timeout:
+            logging.warning(f"{self.name}: Upload of {image.filename} timed out.")
+            raise
+        finally:
+            self.completed(size if ok else 0, ok)
+
+    def completed(self, size, ok):
+        with self.condition:
+            self.in_flight -= 1
+            self.uploads += 1
+            self.bytes_done += size
+            if not ok:
+                self.errors += 1
+            self.window.append((size, ok))
+            if len(self.window) >= self.limit:
+                self.adjust()
+            self.condition.notify_all()
+
+    def adjust(self):
+        """Apply the AIMD policy to the window just completed"""
+        now = time.monotonic()
+        rate = sum(size for size, ok in self.window) / max(now - self.window_started, 1e-6)
+        if not all(ok for size, ok in self.window):
+            self.limit = max(1, self.limit // 2)
+        elif self.window_rate is None or rate >= self.window_rate * 0.95:
+            self.limit = min(self.maximum, self.limit + 1)
+        else:
+            self.limit = max(1, self.limit - 1)
+        self.peak_limit = max(self.peak_limit, self.limit)
+        logging.debug(f"{self.name}: Uploads at {rate/config.MB_SIZE:2.2f} MB/s. Now {self.limit} at once.")
+        self.window_rate = rate
+        self.window = []
+        self.window_started = now
+
+    def wait(self):
+        """Wait for all submitted uploads. Re-raises the first failure."""
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    @property
+    def summary(self) -> str:
+        if self.uploads == 0:
+            return ''
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        cap = f", capped at {self.bandwidth_cap/config.MB_SIZE:2.1f} MB/s" if self.bandwidth_cap else ''
+        return (f"{self.uploads} uploads at {self.bytes_done/config.MB_SIZE/elapsed:2.2f} MB/s, "
+                f"{self.limit} at once at the end (peak {self.peak_limit}, max {self.maximum}){cap}, {self.errors} errors")
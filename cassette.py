@@ -0,0 +1,300 @@
+from collections import deque
+from datetime import datetime
+from xml.etree import ElementTree
+import importlib
+import io
+import json
+import logging
+import threading
+import time
+
+import requests
+
+import config
+
+# A cassette is a JSON Lines file. Each line is one IMatch request:
+#   {"kind": "imatch", "method": "GET", "endpoint": "/v1/files", "params": {...}, "status": 200, "body": "...", "elapsed": 0.01}
+# or one platform api call, with the result or the exception raised as JSON (see Cassette.encode_value):
+#   {"kind": "platform", "platform": "flickr", "call": "photos.setDates", "error": false, "value": "...", "elapsed": 0.2}
+
+# Modules whose exceptions are raised again when replaying. Any other recorded exception is
+# replayed as a RuntimeError, so a cassette can't make us build arbitrary objects.
+REPLAY_ERROR_MODULES = (
+    'builtins',
+    'flickrapi', 'flickrapi.exceptions',
+    'mastodon', 'mastodon.errors', 'mastodon.Mastodon',
+    'requests.exceptions', 'urllib3.exceptions',
+    'outcomes', 'IMatchAPI',
+)
+
+
+class CassetteResponse():
+    """Enough of requests.Response for IMatchAPI, served from a cassette"""
+
+    def __init__(self, status_code, content) -> None:
+        self.status_code = status_code
+        self.content = content
+        self.raw = io.BytesIO(content)
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8')
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error (from cassette)", response=self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class RecordingApi():
+    """Stands in for a platform api object while recording, writing each call's result to the cassette"""
+
+    def __init__(self, cassette, platform, target, path='') -> None:
+        self._cassette = cassette
+        self._platform = platform
+        self._target = target
+        self._path = path
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if isinstance(value, (str, bytes, int, float, list, tuple, dict, type(None))):
+            return value
+        return RecordingApi(self._cassette, self._platform, value, f"{self._path}.{name}" if self._path else name)
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = self._target(*args, **kwargs)
+        except Exception as ex:
+            self._cassette.write_call(self._platform, self._path, time.perf_counter() - start, error=ex)
+            raise
+        self._cassette.write_call(self._platform, self._path, time.perf_counter() - start, result=result)
+        return result
+
+
+class ReplayApi():
+    """Stands in for a platform api object when replaying. Calls are answered in the order they were
+    recorded, by call name, so the arguments (filenames, ids) don't need to match."""
+
+    def __init__(self, cassette, platform, path='') -> None:
+        self._cassette = cassette
+        self._platform = platform
+        self._path = path
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return ReplayApi(self._cassette, self._platform, f"{self._path}.{name}" if self._path else name)
+
+    def __call__(self, *args, **kwargs):
+        return self._cassette.replay_call(self._platform, self._path)
+
+
+class Cassette():
+    """Records every IMatch request (and platform api call) of a run to a file, or replays a run from
+    one, with the recorded timings scaled by config.REPLAY_SPEED. Stands in for the requests module
+    as IMatchAPI.transport."""
+
+    active = None   # The cassette in use for this run, if any
+
+    def __init__(self, path, mode) -> None:
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        if mode == 'record':
+            self.file = open(path, 'w', encoding='utf-8')
+        else:
+            self.load()
+
+    @classmethod
+    def start(cls, path, mode):
+        """Record to or replay from path for the rest of the run. mode is 'record' or 'replay'."""
+        cls.active = Cassette(path, mode)
+        return cls.active
+
+    @property
+    def recording(self) -> bool:
+        return self.mode == 'record'
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == 'replay'
+
+    @staticmethod
+    def request_key(method, endpoint, params):
+        """What a request is matched on, and the ids it is for. Writes carry run-specific data (dates,
+        post ids) so are matched on endpoint alone and answered in the order they were recorded."""
+        if method == 'POST':
+            return (method, endpoint, ()), None
+        ids = params.get('id', params.get('fileid'))
+        return (method, endpoint, tuple(sorted((name, str(value)) for name, value in params.items() if name not in ('auth_token', 'id', 'fileid')))), None if ids is None else str(ids)
+
+    def load(self):
+        self.requests = {}      # (method, endpoint, params without ids) -> {ids : deque of entries}
+        self.records = {}       # (method, endpoint, params without ids) -> list key -> id -> record, for requests batched differently
+        self.asked = {}         # (method, endpoint, params without ids) -> every id asked for
+        self.calls = {}         # (platform, call) -> deque of entries
+        with open(self.path, encoding='utf-8') as cassette_file:
+            for line in cassette_file:
+                entry = json.loads(line)
+                if entry['kind'] == 'imatch':
+                    key, ids = Cassette.request_key(entry['method'], entry['endpoint'], entry['params'])
+                    self.requests.setdefault(key, {}).setdefault(ids, deque()).append(entry)
+                    if ids is not None and entry['status'] == 200:
+                        self.index_records(key, ids, entry)
+                else:
+                    self.calls.setdefault((entry['platform'], entry['call']), deque()).append(entry)
+        logging.info(f"Replaying {sum(len(entries) for by_ids in self.requests.values() for entries in by_ids.values())} IMatch requests and {sum(len(entries) for entries in self.calls.values())} platform calls from {self.path}.")
+
+    def index_records(self, key, ids, entry):
+        """Remember the per-id records in a response, e.g. {'files': [{'id': 1, ...}]}, and which ids
+        were asked for, so an id with no record can be answered too"""
+        try:
+            body = json.loads(entry['body'])
+        except ValueError:
+            return
+        if not isinstance(body, dict):
+            return
+        for list_key, items in body.items():
+            if isinstance(items, list) and all(isinstance(item, dict) and 'id' in item for item in items):
+                self.records.setdefault(key, {}).setdefault(list_key, {}).update((item['id'], item) for item in items)
+        self.asked.setdefault(key, set()).update(int(id) if id.isdigit() else id for id in ids.split(','))
+
+    def write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+
+    @staticmethod
+    def encode_value(value):
+        """json.dumps() default for what the platform apis return beyond plain JSON: flickr's XML
+        responses, Mastodon's datetimes and the exceptions raised"""
+        if ElementTree.iselement(value):
+            return {'__xml__' : ElementTree.tostring(value, encoding='unicode')}
+        if isinstance(value, datetime):
+            return {'__datetime__' : value.isoformat()}
+        if isinstance(value, BaseException):
+            return {
+                '__error__' : f"{type(value).__module__}.{type(value).__qualname__}",
+                'args' : list(value.args),
+                'attributes' : {name : attribute for name, attribute in vars(value).items() if isinstance(attribute, (str, int, float, bool, type(None)))},
+                }
+        raise TypeError(f"{type(value).__name__} can't be recorded")
+
+    @staticmethod
+    def decode_value(value):
+        """json.loads() object_hook undoing encode_value()"""
+        if '__xml__' in value:
+            return ElementTree.fromstring(value['__xml__'])
+        if '__datetime__' in value:
+            return datetime.fromisoformat(value['__datetime__'])
+        if '__error__' in value:
+            module, _, name = value['__error__'].rpartition('.')
+            error_class = getattr(importlib.import_module(module), name, None) if module in REPLAY_ERROR_MODULES else None
+            if isinstance(error_class, type) and issubclass(error_class, BaseException):
+                try:
+                    error = error_class(*value['args'])
+                except Exception:
+                    pass
+                else:
+                    error.__dict__.update(value['attributes'])
+                    return error
+            return RuntimeError(*value['args'])
+        return value
+
+    def write_call(self, platform, call, elapsed, result=None, error=None):
+        try:
+            value = json.dumps(error if error is not None else result, default=Cassette.encode_value)
+        except (TypeError, ValueError):
+            value = json.dumps(RuntimeError(str(error)) if error is not None else None, default=Cassette.encode_value)
+            logging.warning(f"Cassette: could not record the result of {platform} {call}. None will be replayed.")
+        self.write({
+            'kind' : 'platform',
+            'platform' : platform,
+            'call' : call,
+            'elapsed' : elapsed,
+            'error' : error is not None,
+            'value' : value,
+            })
+
+    def wait(self, elapsed):
+        if config.REPLAY_SPEED > 0:
+            time.sleep(elapsed * config.REPLAY_SPEED)
+
+    def get(self, url, params=None, **kwargs):
+        return self.send(requests.get, 'GET', url, params or {}, params=params, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        # As requests.post(), a second positional argument is the form data
+        return self.send(requests.post, 'POST', url, dict(data or {}, **kwargs.get('params', {})), data=data, **kwargs)
+
+    def send(self, send, method, url, sent, **kwargs):
+        """Answer from the cassette, or make the request with send and record it. sent is everything
+        sent with the request, query and form, which is what responses are matched on."""
+        endpoint = '/' + url.split('/', 3)[3]
+        if self.replaying:
+            return self.replay_request(method, endpoint, sent)
+
+        kwargs.pop('stream', None)  # Read whole, so the body can be recorded
+        start = time.perf_counter()
+        response = send(url, **kwargs)
+        self.write({
+            'kind' : 'imatch',
+            'method' : method,
+            'endpoint' : endpoint,
+            'params' : {name : str(value) for name, value in sent.items() if name != 'auth_token'},
+            'status' : response.status_code,
+            'body' : response.text,
+            'elapsed' : time.perf_counter() - start,
+            })
+        return CassetteResponse(response.status_code, response.content)
+
+    def replay_request(self, method, endpoint, params):
+        key, ids = Cassette.request_key(method, endpoint, params)
+        with self.lock:
+            by_ids = self.requests.get(key, {})
+            entries = by_ids.get(ids)
+            if entries is None and ids is None and len(by_ids) > 0:
+                entries = next(iter(by_ids.values()))
+            entry = None
+            if entries is not None and len(entries) > 0:
+                # Recorded answers are used in order. The last is kept for any repeats
+                entry = entries.popleft() if len(entries) > 1 else entries[0]
+        if entry is not None:
+            self.wait(entry['elapsed'])
+            return CassetteResponse(entry['status'], entry['body'].encode('utf-8'))
+
+        # The same ids may have been asked for in different batches when recorded
+        if ids is not None and key in self.records:
+            wanted = [int(id) if id.isdigit() else id for id in ids.split(',')]
+            if self.asked[key].issuperset(wanted):
+                return CassetteResponse(200, json.dumps({
+                    list_key : [records[id] for id in wanted if id in records] for list_key, records in self.records[key].items()
+                    }).encode('utf-8'))
+        raise LookupError(f"Cassette: no recorded response for {method} {endpoint} {params}")
+
+    def replay_call(self, platform, call):
+        with self.lock:
+            entries = self.calls.get((platform, call))
+            if entries is None or len(entries) == 0:
+                raise LookupError(f"Cassette: no recorded response for {platform} {call}")
+            entry = entries.popleft() if len(entries) > 1 else entries[0]
+        if 'value' not in entry:
+            raise LookupError(f"Cassette: {self.path} was recorded by an older version. Record it again.")
+        self.wait(entry['elapsed'])
+        result = json.loads(entry['value'], object_hook=Cassette.decode_value)
+        if entry['error']:
+            raise result
+        return result
+
+    def platform_api(self, platform, api=None):
+        """The api object a platform controller should use: its real api wrapped for recording, or
+        one answering from the cassette when replaying"""
+        if self.replaying:
+            return ReplayApi(self, platform)
+        return RecordingApi(self, platform, api)
@@ -0,0 +1,142 @@
+import logging
+import sys
+import threading
+
+import IMatchAPI as im
+import config
+
+
+class CategoryNode():
+    """One category in the tree"""
+
+    __slots__ = ('path', 'name', 'description', 'children', 'direct_files', 'files')
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.name = path.rpartition("|")[2]
+        self.description = ''
+        self.children = {}              # name -> CategoryNode
+        self.direct_files = frozenset() # Files assigned to this category
+        self.files = frozenset()        # Files assigned to this category or any below it
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(path: {self.path}, children: {len(self.children)}, files: {len(self.files)})"
+
+
+class CategoryTree():
+    """Snapshot of the category trees we work with (config.CATEGORY_SNAPSHOT_ROOTS) loaded from IMatch
+    in one go. Categories are held in a trie keyed on the levels of their | separated path, with an
+    index of file -> categories, so lookups need no further calls to IMatch."""
+
+    FIELDS = 'children,description,directfiles,files,id,name,path'
+
+    __current = None
+    __lock = threading.Lock()
+
+    def __init__(self, roots) -> None:
+        self.roots = roots
+        self.top = CategoryNode('')     # Holds the roots as children
+        self.file_categories = {}       # file id -> set of paths the file is directly assigned to
+
+    @classmethod
+    def snapshot(cls):
+        """The current snapshot, loading it from IMatch on first use"""
+        with cls.__lock:
+            if cls.__current is None:
+                cls.__current = CategoryTree(config.CATEGORY_SNAPSHOT_ROOTS)
+                cls.__current.load()
+            return cls.__current
+
+    @classmethod
+    def refresh(cls):
+        """Forget the current snapshot so the next use reloads it from IMatch"""
+        with cls.__lock:
+            cls.__current = None
+
+    def load(self) -> None:
+        """Load the root categories with everything below them. IMWS returns children nested with the
+        fields asked for. Any it doesn't expand are requested by id a level at a time."""
+        unexpanded = []
+        for root in self.roots:
+            for category in self.request({'path' : root}):
+                unexpanded.extend(self.add(category))
+
+        while len(unexpanded) > 0:
+            requested = unexpanded
+            unexpanded = []
+            for category in self.request({'id' : ",".join(map(str, requested))}):
+                unexpanded.extend(self.add(category))
+        logging.debug(f"Category snapshot loaded for {len(self.file_categories)} files.")
+
+    def request(self, params):
+        """Return the categories IMWS has for params. The Socials tree is the largest response of the
+        run so it is parsed as it streams in if config.STREAM_RESPONSES."""
+        params['fields'] = CategoryTree.FIELDS
+        if config.STREAM_RESPONSES:
+            return im.IMatchAPI.iter_imatch('/v1/categories', params, 'categories.item')
+        response = im.IMatchAPI.get_imatch('/v1/categories', params)
+        if response is None:
+            logging.error(f"Unable to load categories {params} from IMatch.")
+            sys.exit(1)
+        return response['categories']
+
+    def add(self, category) -> list:
+        """Add a category returned by IMWS, and the children returned within it. Returns the ids of
+        children that weren't expanded."""
+        node = self.node(category['path'], create=True)
+        node.description = category.get('description', '')
+        node.direct_files = frozenset(category.get('directFiles', []))
+        node.files = frozenset(category.get('files', []))
+        for file_id in node.direct_files:
+            self.file_categories.setdefault(file_id, set()).add(node.path)
+
+        unexpanded = []
+        for child in category.get('children', []):
+            if isinstance(child, dict) and 'path' in child:
+                unexpanded.extend(self.add(child))
+            else:
+                unexpanded.append(child['id'] if isinstance(child, dict) else child)
+        return unexpanded
+
+    def node(self, path, create=False):
+        """Return the node for path, or None if there is no such category"""
+        node = self.top
+        walked = []
+        for level in path.split("|"):
+            walked.append(level)
+            try:
+                node = node.children[level]
+            except KeyError:
+                if not create:
+                    return None
+                node.children[level] = CategoryNode(sys.intern("|".join(walked)))
+                node = node.children[level]
+        return node
+
+    def children(self, path) -> list:
+        node = self.node(path)
+        return [] if node is None else list(node.children.values())
+
+    def direct_files(self, path) -> frozenset:
+        node = self.node(path)
+        return frozenset() if node is None else node.direct_files
+
+    def files(self, path) -> frozenset:
+        node = self.node(path)
+        return frozenset() if node is None else node.files
+
+    def descendants(self, path):
+        """Yield every category below path"""
+        node = self.node(path)
+        pending = [] if node is None else list(node.children.values())
+        while len(pending) > 0:
+            node = pending.pop()
+            yield node
+            pending.extend(node.children.values())
+
+    def categories_of(self, file_id) -> dict:
+        """The categories in the snapshot the file is assigned to, as path -> description"""
+        return {path : self.node(path).description for path in self.file_categories.get(file_id, ())}
+
+    def is_in(self, file_id, path) -> bool:
+        return path in self.file_categories.get(file_id, ())
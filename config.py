@@ -1,3 +1,8 @@
+import os
+
+# Where local state (lock files, databases) is kept. Alongside the scripts.
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
 # Root socials category
 ROOT_CATEGORY = "Socials"
 
@@ -13,3 +18,110 @@ MB_SIZE = 1048576
 
 # Set TESTING to True to flag, but not action add, delete and update to platforms and IMatch metadata
 TESTING = False
+
+# Keyword rules. How a hierarchical keyword (or category path) becomes the flat tags posted
+# to the platforms, keyed on the root level of the keyword. Roots without a rule are not posted.
+#   levels         : (start, stop) slice of the levels to post. The root itself is level 0
+#   normalise      : strip spaces and dashes, and & becomes "and". Defaults to True
+#   suffix         : also post each level with this appended (normalised)
+#   suffix_exclude : levels that do not get the suffix
+KEYWORD_RULES = {
+    'art' : {'levels' : (0, None)},
+    'genre' : {'levels' : (1, None), 'normalise' : False, 'suffix' : 'photography', 'suffix_exclude' : ['astrophotography']},
+    'Location' : {'levels' : (3, 5)},   # town, location
+    'nature' : {'levels' : (1, None)},
+    'toys and games' : {'levels' : (1, None)},
+}
+
+CATEGORY_KEYWORD_RULES = {
+    'Image Characteristics' : {'levels' : (-1, None)},  # the leaf
+}
+
+# Number of distinct keywords to remember the tags for
+KEYWORD_CACHE_SIZE = 8192
+
+# Pixelfed. Seconds between checks on media the server is still processing.
+PIXELFED_POLL_INTERVAL = 2
+# Pixelfed. Checks to wait, PIXELFED_POLL_INTERVAL apart, for the last media to be processed before
+# giving up on it
+PIXELFED_PROCESSING_POLLS = 150
+# Pixelfed. Retries for uploads and posts that fail with a network or server error, waiting
+# PIXELFED_RETRY_BACKOFF seconds before the first and doubling each time after.
+PIXELFED_RETRIES = 4
+PIXELFED_RETRY_BACKOFF = 2
+
+# Flickr. Upload without waiting for flickr to process each photo, and check on the uploads
+# (tickets) together, FLICKR_TICKET_BATCH at a time, every FLICKR_POLL_INTERVAL seconds.
+FLICKR_ASYNC_UPLOADS = True
+FLICKR_TICKET_BATCH = 100
+FLICKR_POLL_INTERVAL = 2
+# Flickr. Checks to wait, FLICKR_POLL_INTERVAL apart, for the last uploads to be processed before
+# giving up on them
+FLICKR_PROCESSING_POLLS = 150
+# Flickr. Threads setting dates, albums, groups and tags on uploaded photos while the next uploads go.
+FLICKR_FINISHER_WORKERS = 2
+# Flickr. Error codes worth retrying: 0 API unavailable, 105 service unavailable, 106 write failed
+FLICKR_RETRYABLE_CODES = (0, 105, 106)
+# Flickr. Error code for a photo already in the album or group it is being added to
+FLICKR_ALREADY_ADDED_CODE = 3
+
+# Audit. Posts found on a platform with no matching IMatch record are only reported unless this is True
+AUDIT_DELETE_UNTRACKED = False
+
+# Seconds between checks for changes in IMatch when running with --daemon
+DAEMON_POLL_INTERVAL = 30
+# With --daemon, also update posts whose files have been edited in IMatch since they were posted.
+# Off by default: an update re-uploads the whole file to flickr, and IMatch marks a file modified
+# for any metadata write-back. Otherwise posts are only updated from the update category.
+DAEMON_UPDATE_EDITED = False
+
+# Images gathered from IMatch at once. Their requests to IMatch are combined where possible
+GATHER_WORKERS = 8
+
+# Classify this many images or more as columns with numpy, if it is installed
+IMAGE_TABLE_MIN_IMAGES = 1000
+
+# With --stream, images are gathered and committed STREAM_BATCH_SIZE at a time, with gathering
+# at most STREAM_QUEUE_DEPTH batches ahead of committing.
+STREAM_BATCH_SIZE = 50
+STREAM_QUEUE_DEPTH = 2
+
+# Parse the category tree as it arrives rather than all at once. Uses ijson if installed. The file
+# records for gathering are always streamed this way.
+STREAM_RESPONSES = True
+
+# Category trees loaded from IMatch once at startup. Image categories outside these are not seen
+CATEGORY_SNAPSHOT_ROOTS = [ROOT_CATEGORY] + list(CATEGORY_KEYWORD_RULES.keys())
+
+# Held while a sharded run (--shards) is in progress so two can't work on the same images
+SHARD_LOCK_FILE = os.path.join(DATA_DIR, "share_images.lock")
+
+# Persistent queue of platform operations. Resumes interrupted runs in the same order.
+QUEUE_DATABASE = os.path.join(DATA_DIR, "work_queue.sqlite")
+# Order work is done in. Any of 'deletes_first', 'smallest_first' and 'date_taken', most important first
+QUEUE_PRIORITY = ['deletes_first', 'smallest_first']
+# Attempts at an operation before it is set aside and the image reported as an error
+QUEUE_MAX_ATTEMPTS = 3
+
+# Operations that fail with a retryable error (timeouts, server errors) are tried again at the end
+# of their batch, up to COMMIT_RETRIES times, waiting COMMIT_RETRY_BACKOFF seconds before the first
+# and doubling each time after. Any still failing are reported as errors and left queued.
+COMMIT_RETRIES = 2
+COMMIT_RETRY_BACKOFF = 5
+
+# Uploads run several at once. The number is tuned as the run goes from the bytes/sec achieved
+# and any errors, starting at UPLOAD_INITIAL_WORKERS and never more than UPLOAD_MAX_WORKERS.
+UPLOAD_INITIAL_WORKERS = 2
+UPLOAD_MAX_WORKERS = 6
+# Bytes/sec to keep uploads under, e.g. 2 * MB_SIZE. None for no cap
+UPLOAD_BANDWIDTH_CAP = None
+
+# Replaying a recorded run (--replay) waits for each response this many times as long as it took
+# when recorded. 0 replays as fast as possible.
+REPLAY_SPEED = 1.0
+
+# Every run's timings and counts are added to this database. Report on them with: python run_history.py
+RECORD_HISTORY = True
+HISTORY_DATABASE = os.path.join(DATA_DIR, "run_history.sqlite")
+# Fraction worse than the previous period that the report flags as a regression
+HISTORY_REGRESSION_THRESHOLD = 0.4
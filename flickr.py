@@ -1,13 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import sys
 import logging
+import threading
+import time
 
 import flickrapi
 
+from category_tree import CategoryTree
 from imatch_image import IMatchImage
 import IMatchAPI as im
+from outcomes import PermanentError
 from platform_base import PlatformController
+from tracing import Trace
 import config
+import validation
 
 logging.getLogger("flickrapi.core").setLevel(logging.WARN)  # Hide basic info messages
 
@@ -15,9 +22,13 @@ logging.getLogger("flickrapi.core").setLevel(logging.WARN)  # Hide basic info me
 class FlickrImage(IMatchImage):
 
     __MAX_SIZE = 200 * config.MB_SIZE
+    __slots__ = ('albums', 'groups', 'full_description')
+    VALIDATION_RULES = IMatchImage.VALIDATION_RULES + (
+        validation.max_size(__MAX_SIZE),
+        )
 
-    def __init__(self, id, platform) -> None:
-        super().__init__(id, platform)
+    def __init__(self, record, platform) -> None:
+        super().__init__(record, platform)
 
         if self.size > FlickrImage.__MAX_SIZE:
             logging.warning(f'{self.name}: {self.filename} may be too large to upload: {self.size/config.MB_SIZE:2.1f} MB. Max is {FlickrImage.__MAX_SIZE/config.MB_SIZE:2.1f} MB.')
@@ -34,8 +45,8 @@ class FlickrImage(IMatchImage):
         self.albums = []
         self.groups = []
 
-        for category in self.categories:
-            splits = category['path'].split("|")
+        for path, description in self.categories.items():
+            splits = path.split("|")
             match splits[0]:
                 case "Socials":
                     if splits[1] == "flickr":
@@ -43,10 +54,10 @@ class FlickrImage(IMatchImage):
                         try:
                             if splits[2] == "albums":
                                 # Code is in the description
-                                self.albums.append(category['description'])
+                                self.albums.append(description)
                             if splits[2] == "groups":
                                 # Code is in the description due to the presence of @ being illegal in the name
-                                self.groups.append(category['description'])
+                                self.groups.append(description)
                         except IndexError:
                             pass #no groups or albums found
 
@@ -61,15 +72,6 @@ class FlickrImage(IMatchImage):
         self.full_description = "\n".join(tmp_description)       
         return None
     
-    @property
-    def is_valid(self) -> bool:
-        result = super().is_valid
-        if self.size > FlickrImage.__MAX_SIZE:
-            logging.error(f'{self.controller.name}: Skipping {self.name} is too large to upload: {self.size/config.MB_SIZE:2.1f} MB. Max is {FlickrImage.__MAX_SIZE/config.MB_SIZE:2.1f} MB.')
-            print(f'{self.controller.name}: Skipping {self.name} is too large to upload: {self.size/config.MB_SIZE:2.1f} MB. Max is {FlickrImage.__MAX_SIZE/config.MB_SIZE:2.1f} MB.')
-            self.errors.append(f"file too large")
-        return len(self.errors) == 0 and result
-
     @property
     def is_on_platform(self) -> bool:
         res = im.IMatchAPI.get_attributes("flickr", self.id)
@@ -77,29 +79,49 @@ class FlickrImage(IMatchImage):
     
 class FlickrController(PlatformController):
 
+    POST_ID_ATTRIBUTE = 'photo_id'
+    ADDS_FINISH_LATER = True
+    AUDIT_PAGE_SIZE = 500   # The most flickr will return per page
+
     def __init__(self, platform) -> None:
         super().__init__(platform)
-        self.privacy = {
-            'is_public' : im.IMatchAPI.get_application_variable("flickr_is_public"),
-            'is_family' : im.IMatchAPI.get_application_variable('flickr_is_family'),
-            'is_friend' : im.IMatchAPI.get_application_variable('flickr_is_friend')
-        }
-
-        self.organisation_categories = {}
-        for category in ['albums', 'groups']:
-            category_info = im.IMatchAPI.get_category_info(
-                category = im.IMatchUtility.build_category([
-                    config.ROOT_CATEGORY,
-                    self.name,
-                    category
-                    ]),
-                params = {
-                    'fields' : 'children,name,description'
-                }
-            )
-            self.organisation_categories[category] = {}
-            for imatch_cat in category_info[0]['children']:
-                self.organisation_categories[category][imatch_cat['description']] = imatch_cat
+        # Both are worked out on first use. A run with nothing to do never needs them.
+        self._privacy = None
+        self._organisation_categories = None
+        self._tickets = {}      # Upload ticket id -> image, for uploads flickr is still processing
+        self._tickets_lock = threading.Lock()
+        self._tickets_checked = 0
+        # Runs finish_upload() for uploaded photos, so uploading carries on meanwhile. Made here rather
+        # than on first use, as photos are handed to it from several upload threads. It starts no
+        # threads until then.
+        self._finisher = ThreadPoolExecutor(max_workers=config.FLICKR_FINISHER_WORKERS, thread_name_prefix=f"{self.name}-finisher")
+        self._finishing = []    # Futures from the finisher
+
+    @property
+    def privacy(self):
+        if self._privacy is None:
+            self._privacy = {
+                'is_public' : im.IMatchAPI.get_application_variable("flickr_is_public"),
+                'is_family' : im.IMatchAPI.get_application_variable('flickr_is_family'),
+                'is_friend' : im.IMatchAPI.get_application_variable('flickr_is_friend')
+            }
+        return self._privacy
+
+    @property
+    def organisation_categories(self):
+        if self._organisation_categories is None:
+            self._organisation_categories = {}
+            for category in ['albums', 'groups']:
+                self._organisation_categories[category] = {}
+                for imatch_cat in CategoryTree.snapshot().children(
+                    im.IMatchUtility.build_category([
+                        config.ROOT_CATEGORY,
+                        self.name,
+                        category
+                        ])
+                    ):
+                    self._organisation_categories[category][imatch_cat.description] = imatch_cat
+        return self._organisation_categories
 
     def connect(self):
         if self.api is not None:
@@ -123,148 +145,245 @@ class FlickrController(PlatformController):
             self.api = flickr
 
 
-    def commit_add(self, image):       
-        """Make the api call to commit the image to the platform, and update IMatch with reference details"""
-        try:
-            response = self.api.upload(
-                image.filename,
-                title = image.title if image.title != '' else image.name,
-                description = image.full_description,
-                is_public = self.privacy['is_public'],
-                is_friend = self.privacy['is_friend'],
-                is_family = self.privacy['is_family'],
-                )
-            
-            photo_id = response.findtext('photoid')
-            
-            # Since we expect no EXIF data in the file, flickr will take the upload time from the last modified date of the file
-            # and ignore XMP::EXIF fields. Fix that by setting the time ourselves. The format we have is 
-            response = self.api.photos.setDates(photo_id=photo_id, date_taken=str(image.date_time), date_taken_granularity=0)
-
-            for album in image.albums:
-                response = self.api.photosets_addPhoto(photoset_id=album, photo_id=photo_id)
-
-            for group in image.groups:
-                response = self.api.groups_pools_add(group_id=group, photo_id=photo_id)
-
-            # flickr will bring in hierarchical keywords not under our control as level|level|level
-            # which frankly is stupid. Easiest way is to delete them all. We don't know quite what
-            # it will have loaded.
-            ### THIS CODE IS NOT WORKING AND I CAN"T WORK OUT WHY. Does not delete, ALWAYS returns "ok"
-            # resp = self.api.photos.getInfo(photo_id = photo_id, format = "parsed-json")
-            # for badtag in resp['photo']['tags']['tag']:
-            #     resp = self.api.photos.removeTag(tag=badtag['id'])
-            #     
-            
-            # Now add back the "Approved" tags. If added on upload, they combine with IPTC weirdly
-            resp = self.api.photos.addTags(tags=",".join(image.keywords), photo_id=photo_id)
-        except flickrapi.FlickrError as fe:
+    def list_posts(self):
+        """Yield the id of every photo on the account, a page at a time"""
+        page = 1
+        pages = 1
+        while page <= pages:
+            try:
+                response = self.api.people.getPhotos(
+                    user_id = 'me',
+                    per_page = FlickrController.AUDIT_PAGE_SIZE,
+                    page = page,
+                    format = 'parsed-json'
+                    )
+            except flickrapi.FlickrError as fe:
                 logging.error(fe)
                 sys.exit(1)
+            pages = int(response['photos']['pages'])
+            for photo in response['photos']['photo']:
+                yield photo['id']
+            page += 1
 
-        # Update the image in IMatch by adding the attributes below.
+    def delete_post(self, post_id):
+        try:
+            self.api.photos.delete(photo_id = post_id)
+        except flickrapi.FlickrError as fe:
+            logging.error(fe)
+            sys.exit(1)
+
+    def commit_add(self, image):       
+        """Make the api call to commit the image to the platform, and update IMatch with reference details.
+        With FLICKR_ASYNC_UPLOADS the upload returns a ticket straight away, and the rest is done by
+        check_tickets() once flickr has processed the photo."""
+        upload_args = {}
+        if config.FLICKR_ASYNC_UPLOADS:
+            upload_args['async'] = 1
+        response = self.api.upload(
+            image.filename,
+            title = image.title if image.title != '' else image.name,
+            description = image.full_description,
+            is_public = self.privacy['is_public'],
+            is_friend = self.privacy['is_friend'],
+            is_family = self.privacy['is_family'],
+            **upload_args
+            )
+
+        if config.FLICKR_ASYNC_UPLOADS:
+            with self._tickets_lock:
+                self._tickets[response.findtext('ticketid')] = image
+            self.check_tickets()
+        else:
+            self.finish(image, response.findtext('photoid'))
+
+    def is_retryable(self, error) -> bool:
+        if isinstance(error, flickrapi.FlickrError):
+            # No code means the request itself failed rather than flickr turning it down
+            return error.code is None or error.code in config.FLICKR_RETRYABLE_CODES
+        return super().is_retryable(error)
+
+    def check_tickets(self, wait = False):
+        """Ask flickr about outstanding upload tickets, a batch per call, and finish the photos that are done.
+        Only checks every FLICKR_POLL_INTERVAL seconds unless waiting, and only one thread checks at a time.
+        Returns False if flickr couldn't be asked, to be tried again at the next check."""
+        if not self._tickets_lock.acquire(blocking=wait):
+            return True
+        try:
+            if not wait and time.monotonic() - self._tickets_checked < config.FLICKR_POLL_INTERVAL:
+                return True
+            self._tickets_checked = time.monotonic()
+            ticket_ids = list(self._tickets.keys())
+            for start in range(0, len(ticket_ids), config.FLICKR_TICKET_BATCH):
+                batch = ticket_ids[start:start + config.FLICKR_TICKET_BATCH]
+                try:
+                    response = self.api.photos.upload.checkTickets(tickets = ",".join(batch), format = 'parsed-json')
+                except flickrapi.FlickrError as fe:
+                    logging.warning(f"{self.name}: Unable to check upload tickets: {fe}")
+                    return False
+                for ticket in response['uploader']['ticket']:
+                    # complete is 0 while processing, 1 when done and 2 if flickr failed to process the upload
+                    complete = int(ticket.get('complete', 0))
+                    if ticket.get('invalid') or complete == 2:
+                        image = self._tickets.pop(ticket['id'])
+                        print(f"{self.name}: Flickr failed to process the upload of {image.filename}.")
+                        self.failed(image, IMatchImage.OP_ADD, PermanentError("upload failed"))
+                    elif complete == 1:
+                        image = self._tickets.pop(ticket['id'])
+                        self.finish(image, ticket['photoid'])
+            return True
+        finally:
+            self._tickets_lock.release()
+
+    def finish(self, image, photo_id):
+        """Hand an uploaded photo to the finisher"""
+        self._finishing.append(self._finisher.submit(Trace.carry(self.commit), image, IMatchImage.OP_ADD, self.finish_upload, photo_id))
+
+    def finish_adds(self):
+        """Wait for flickr to process all outstanding uploads, then for the finisher to set them up.
+        Uploads still unconfirmed after COMMIT_RETRIES failed checks in a row, or FLICKR_PROCESSING_POLLS
+        checks in all, are reported as errors. They are not uploaded again, as flickr may yet have them."""
+        failed_checks = 0
+        deadline = time.monotonic() + config.FLICKR_PROCESSING_POLLS * config.FLICKR_POLL_INTERVAL
+        while len(self._tickets) > 0:
+            failed_checks = 0 if self.check_tickets(wait = True) else failed_checks + 1
+            if failed_checks > config.COMMIT_RETRIES or time.monotonic() > deadline:
+                with self._tickets_lock:
+                    unconfirmed, self._tickets = list(self._tickets.values()), {}
+                for image in unconfirmed:
+                    self.failed(image, IMatchImage.OP_ADD, PermanentError("upload not confirmed"))
+            if len(self._tickets) > 0:
+                time.sleep(config.FLICKR_POLL_INTERVAL)
+        for future in self._finishing:
+            future.result()
+        self._finishing = []
+
+    def finish_upload(self, image, photo_id):
+        """Update IMatch with reference details, then set everything that can't be set on upload"""
+        # Record the post first. The photo is on flickr now, so if setting it up fails it must
+        # not be uploaded again. It can be put right with an update.
         posted = datetime.now().isoformat()[:10]
         im.IMatchAPI.set_attributes(self.name, image.id, data = {
             'posted' : posted,
             'photo_id' : photo_id,
             'url' : f"https://www.flickr.com/photos/dcbuchan/{photo_id}"
             })
+
+        # Since we expect no EXIF data in the file, flickr will take the upload time from the last modified date of the file
+        # and ignore XMP::EXIF fields. Fix that by setting the time ourselves. The format we have is 
+        response = self.api.photos.setDates(photo_id=photo_id, date_taken=str(image.date_time), date_taken_granularity=0)
+
+        # A retry may find the photo already added by the first try
+        for album in image.albums:
+            self.add_once(self.api.photosets_addPhoto, photoset_id=album, photo_id=photo_id)
+
+        for group in image.groups:
+            self.add_once(self.api.groups_pools_add, group_id=group, photo_id=photo_id)
+
+        # flickr will bring in hierarchical keywords not under our control as level|level|level
+        # which frankly is stupid. Easiest way is to delete them all. We don't know quite what
+        # it will have loaded.
+        ### THIS CODE IS NOT WORKING AND I CAN"T WORK OUT WHY. Does not delete, ALWAYS returns "ok"
+        # resp = self.api.photos.getInfo(photo_id = photo_id, format = "parsed-json")
+        # for badtag in resp['photo']['tags']['tag']:
+        #     resp = self.api.photos.removeTag(tag=badtag['id'])
+        #     
+        
+        # Now add back the "Approved" tags. If added on upload, they combine with IPTC weirdly
+        resp = self.api.photos.addTags(tags=",".join(image.keywords), photo_id=photo_id)
                             
-    def commit_delete(self, image):
-        """Make the api call to delete the image from the platform"""
+    def add_once(self, add, **kwargs):
+        """Add a photo to an album or group, taking it already being there as done"""
         try:
-            attributes = im.IMatchAPI().get_attributes(self.name, image.id)[0]
-            photo_id = attributes['photo_id']
-            response = self.api.photos.delete(photo_id = photo_id)
+            add(**kwargs)
         except flickrapi.FlickrError as fe:
-            logging.error(fe)
-            logging.error(response)
-            sys.exit(1)
+            if fe.code != config.FLICKR_ALREADY_ADDED_CODE:
+                raise
+
+    def commit_delete(self, image):
+        """Make the api call to delete the image from the platform"""
+        attributes = im.IMatchAPI().get_attributes(self.name, image.id)[0]
+        photo_id = attributes['photo_id']
+        response = self.api.photos.delete(photo_id = photo_id)
 
     def commit_update(self, image):
         """Make the api call to update the image on the platform"""
+        attributes = im.IMatchAPI().get_attributes(self.name, image.id)[0]
+        photo_id = attributes['photo_id']
+
+        response = self.api.photos.setMeta(
+            title = image.title if image.title != '' else image.name,
+            description = image.full_description,  
+            photo_id = photo_id
+            )        
+
+        response = self.api.replace(
+            filename = image.filename, 
+            photo_id = photo_id
+            )
+
+        response = self.api.photos.setDates(photo_id=photo_id, date_taken=str(image.date_time), date_taken_granularity=0)
+        response = self.api.photos.addTags(tags=",".join(image.keywords), photo_id=photo_id)
+
+        contexts = self.api.photos.getAllContexts(
+            photo_id = photo_id, 
+            format="parsed-json"
+            )
+        
         try:
-            attributes = im.IMatchAPI().get_attributes(self.name, image.id)[0]
-            photo_id = attributes['photo_id']
-
-            response = self.api.photos.setMeta(
-                title = image.title if image.title != '' else image.name,
-                description = image.full_description,  
-                photo_id = photo_id
-                )        
-
-            response = self.api.replace(
-                filename = image.filename, 
-                photo_id = photo_id
-                )
-
-            response = self.api.photos.setDates(photo_id=photo_id, date_taken=str(image.date_time), date_taken_granularity=0)
-            response = self.api.photos.addTags(tags=",".join(image.keywords), photo_id=photo_id)
-
-            contexts = self.api.photos.getAllContexts(
-                photo_id = photo_id, 
-                format="parsed-json"
-                )
-            
-            try:
-                for flickr_album in contexts['set']:
-                    # Is the image in the album flickr thinks its in
-                    match = list(filter(lambda album: album == flickr_album['id'], image.albums))
-                    if len(match) == 0:
-                        # Flickr says this image is in the album (set). IMatch doesn't think it should be
-                        response = self.api.photosets_removePhoto(
-                            photoset_id = flickr_album['id'], 
-                            photo_id = photo_id
-                            )
-            except KeyError:
-                # No set information returned so not in any flickr albums
-                pass
-
-            for album in image.albums:
-                if "set" in contexts:
-                    match = list(filter(lambda set: set['id'] == album, contexts['set']))
-                    if len(match) == 0:
-                        response = self.api.photosets_addPhoto(
-                            photoset_id = album,
-                            photo_id = photo_id
-                            )        
-                else:
-                    # No albums set, can go ahead and add
+            for flickr_album in contexts['set']:
+                # Is the image in the album flickr thinks its in
+                match = list(filter(lambda album: album == flickr_album['id'], image.albums))
+                if len(match) == 0:
+                    # Flickr says this image is in the album (set). IMatch doesn't think it should be
+                    response = self.api.photosets_removePhoto(
+                        photoset_id = flickr_album['id'], 
+                        photo_id = photo_id
+                        )
+        except KeyError:
+            # No set information returned so not in any flickr albums
+            pass
+
+        for album in image.albums:
+            if "set" in contexts:
+                match = list(filter(lambda set: set['id'] == album, contexts['set']))
+                if len(match) == 0:
                     response = self.api.photosets_addPhoto(
                         photoset_id = album,
+                        photo_id = photo_id
+                        )        
+            else:
+                # No albums set, can go ahead and add
+                response = self.api.photosets_addPhoto(
+                    photoset_id = album,
+                    photo_id=photo_id
+                    )
+
+        try:
+            for flickr_group in contexts['pool']:
+                # Is the image in the album flickr thinks its in
+                match = list(filter(lambda group: group == flickr_group['id'], image.groups))
+                if len(match) == 0:
+                    # Flickr says this image is in the group (pool). IMatch doesn't think it should be
+                    response = self.api.groups_pools_remove(
+                        group_id=flickr_group['id'],
                         photo_id=photo_id
                         )
-
-            try:
-                for flickr_group in contexts['pool']:
-                    # Is the image in the album flickr thinks its in
-                    match = list(filter(lambda group: group == flickr_group['id'], image.groups))
-                    if len(match) == 0:
-                        # Flickr says this image is in the group (pool). IMatch doesn't think it should be
-                        response = self.api.groups_pools_remove(
-                            group_id=flickr_group['id'],
-                            photo_id=photo_id
-                            )
-            except KeyError:
-                # No pool information returned so not in any flickr groups
-                pass
-
-            for group in image.groups:
-                if "pool" in contexts:
-                    match = list(filter(lambda set: set['id'] == group, contexts['pool']))
-                    if len(match) == 0:
-                        response = self.api.groups_pools_add(
-                            group_id = group, 
-                            photo_id=photo_id
-                            )        
-                else:
-                    # No groups set, can go ahead and add
+        except KeyError:
+            # No pool information returned so not in any flickr groups
+            pass
+
+        for group in image.groups:
+            if "pool" in contexts:
+                match = list(filter(lambda set: set['id'] == group, contexts['pool']))
+                if len(match) == 0:
                     response = self.api.groups_pools_add(
                         group_id = group, 
                         photo_id=photo_id
-                        )   
-        except flickrapi.FlickrError as fe:
-            logging.error(fe)
-            logging.error(response)
-            sys.exit(1)
+                        )        
+            else:
+                # No groups set, can go ahead and add
+                response = self.api.groups_pools_add(
+                    group_id = group, 
+                    photo_id=photo_id
+                    )   
 
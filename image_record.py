@@ -0,0 +1,167 @@
+from datetime import datetime
+import logging
+import sys
+import threading
+import weakref
+
+from category_tree import CategoryTree
+import IMatchAPI as im
+
+
+class ImageRecord():
+    """What IMatch holds for one file: its metadata, the master's metadata and its categories.
+    Records are shared while any platform image holds them, so a file shared to several platforms
+    is only fetched from IMatch once. They are held weakly here, so the images retired after each
+    batch of a --stream run take their records with them. Platform images read through to their
+    record (see IMatchImage)."""
+
+    __slots__ = (
+        'id', 'lock', 'loaded', 'has_file',
+        'filename', 'date_time', 'name', 'size',
+        'master_id', 'title', 'description', 'hierarchical_keywords', 'headline',
+        'aperture', 'focal_length', 'iso', 'lens', 'model', 'shutter_speed',
+        'categories',
+        '__weakref__',
+        )
+
+    # IMWS response field -> attribute name, for the fields we ask for by name
+    FILE_FIELDS = {
+        'fileName' : 'filename',
+        'dateTime' : 'date_time',
+        'name' : 'name',
+        'size' : 'size',
+        'id' : None,    # Already known
+        }
+    FILE_PARAMS = {
+        "fields" : "datetime,filename,name,size",
+        }
+
+    __records = weakref.WeakValueDictionary()
+    __lock = threading.Lock()
+    __loads = 0     # Records loaded from IMatch this run
+
+    def __init__(self, id) -> None:
+        self.id = id
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.has_file = False   # The version's own details, which may come ahead of the rest (see stream)
+
+    @classmethod
+    def of(cls, id):
+        """The record for file id, fetched from IMatch the first time any platform asks for it"""
+        with cls.__lock:
+            try:
+                record = cls.__records[id]
+            except KeyError:
+                record = cls.__records[id] = ImageRecord(id)
+        # Loaded under the record's own lock, so different files load at the same time (and their
+        # requests coalesce) while a second platform asking for the same file waits for the first.
+        with record.lock:
+            if not record.loaded:
+                record.load()
+                record.loaded = True
+                with cls.__lock:
+                    cls.__loads += 1
+        return record
+
+    @classmethod
+    def stream(cls, ids):
+        """Yield the records for ids. The details of files not yet known are fetched in one streamed
+        request, and each record is yielded as its part of the response arrives, so work on it can
+        start before the rest has loaded. The remainder is loaded by of()."""
+        unknown = []
+        for id in ids:
+            with cls.__lock:
+                record = cls.__records.get(id)
+            if record is None:
+                unknown.append(id)
+            else:
+                yield record
+        if len(unknown) == 0:
+            return
+        for file in im.IMatchAPI.iter_file_metadata(unknown, ImageRecord.FILE_PARAMS):
+            with cls.__lock:
+                try:
+                    record = cls.__records[file['id']]
+                except KeyError:
+                    record = cls.__records[file['id']] = ImageRecord(file['id'])
+            with record.lock:
+                if not record.has_file:
+                    record.set_file(file)
+            yield record
+
+    @classmethod
+    def clear(cls):
+        """Forget every record, e.g. when IMatch may have changed since they were fetched"""
+        with cls.__lock:
+            cls.__records.clear()
+
+    @classmethod
+    def count(cls) -> int:
+        """The number of records loaded from IMatch this run"""
+        return cls.__loads
+
+    def set_file(self, image_info) -> None:
+        """Set the version's own details from its /v1/files record"""
+        for attribute, value in image_info.items():
+            try:
+                slot = ImageRecord.FILE_FIELDS[attribute]
+            except KeyError:
+                logging.debug(f"Unexpected attribute {attribute} returned from get_file_metadata() call")
+                continue
+            match slot:
+                case None:
+                    pass
+                case "date_time":
+                    self.date_time = datetime.strptime(value,'%Y-%m-%dT%H:%M:%S')
+                case other:
+                    setattr(self, slot, value)
+        self.has_file = True
+
+    def load(self) -> None:
+        # -----------------------------------------------------------------------------
+        # This is the information we want from the version to be be posted, and later
+        # the master. Certain camera and shooting information is not propogated through
+        # the versions, so we will need to walk back up the version > master tree to
+        # obtain it.
+        if not self.has_file:
+            self.set_file(im.IMatchAPI.get_file_metadata([self.id], params=ImageRecord.FILE_PARAMS)[0])
+
+        # Now grab the information from the master. This also protects us if the
+        # metadata has not yet been propogated.
+        master_params = {
+            "fields" : "", # Setting to "" stops retrieval of more than we need
+            "tagtitle" : "title",
+            "tagdescription" : "description",
+            "taghierarchical_keywords" : "hierarchicalkeywords",
+            "varaperture" : "{File.MD.aperture}",
+            "varfocal_length" : "{File.MD.focallength|value:formatted}",
+            "varheadline" : "{File.MD.headline}",
+            "variso" : "{File.MD.iso|value:formatted}",
+            "varlens" : "{File.MD.lens}",
+            "varmodel" : "{File.MD.model}",
+            "varshutter_speed" : "{File.MD.shutterspeed|value:formatted}"
+            }
+
+        self.master_id = im.IMatchAPI.get_master_id(self.id)
+        if self.master_id == None:
+            # We are the master, use original id
+            self.master_id = self.id
+        image_info = im.IMatchAPI.get_file_metadata([self.master_id],master_params)[0]
+        for attribute, value in image_info.items():
+            match attribute:
+                case "hierarchical_keywords":
+                    # The same few thousand keywords repeat across the library. Intern them
+                    # so every image shares the one copy.
+                    self.hierarchical_keywords = tuple(sys.intern(keyword) for keyword in value)
+                case "id" | "lock" | "loaded" | "has_file":
+                    pass
+                case other:
+                    try:
+                        setattr(self, attribute, value)
+                    except AttributeError:
+                        logging.debug(f"Unexpected attribute {attribute} returned from get_file_metadata() call")
+
+        # The categories the file belongs to, from the snapshot loaded at startup. Held as
+        # path -> description. The paths are interned in the snapshot.
+        self.categories = CategoryTree.snapshot().categories_of(self.id)
@@ -0,0 +1,61 @@
+try:
+    import numpy as np  # Optional. Columnar classification for large libraries. pip3 install numpy
+except ImportError:
+    np = None
+
+from category_tree import CategoryTree
+import IMatchAPI as im
+from imatch_image import IMatchImage
+import config
+
+
+class ImageTable():
+    """A platform's gathered images held as columns (NumPy arrays), one row per image, so they can
+    be classified with boolean masks rather than image by image. Only available with numpy, which is
+    only imported when a batch is large enough to use it (see PlatformController.classify_images)."""
+
+    COLUMNS = ('id', 'master_id', 'size', 'valid', 'on_platform', 'update', 'delete')
+
+    def __init__(self, **columns) -> None:
+        for column in ImageTable.COLUMNS:
+            setattr(self, column, columns[column])
+
+    @classmethod
+    def available(cls) -> bool:
+        return np is not None
+
+    @classmethod
+    def from_images(cls, platform, images, edited_ids=()):
+        """Build the table in one pass over images. Membership of the platform's update and delete
+        categories comes straight from the category snapshot. Images edited in IMatch since they
+        were posted (edited_ids) want an update as well."""
+        categories = CategoryTree.snapshot()
+        updates = categories.direct_files(im.IMatchUtility.build_category([config.ROOT_CATEGORY, platform, config.UPDATE_CATEGORY]))
+        ids = np.fromiter((image.id for image in images), dtype=np.int64, count=len(images))
+        return cls(
+            id = ids,
+            master_id = np.fromiter((image.master_id for image in images), dtype=np.int64, count=len(images)),
+            size = np.fromiter((image.size for image in images), dtype=np.int64, count=len(images)),
+            valid = np.fromiter((len(image.errors) == 0 for image in images), dtype=bool, count=len(images)),
+            on_platform = np.fromiter((image.on_platform is True for image in images), dtype=bool, count=len(images)),
+            update = np.isin(ids, np.fromiter(set(updates) | set(edited_ids), dtype=np.int64)),
+            delete = np.isin(ids, np.fromiter(categories.direct_files(
+                im.IMatchUtility.build_category([config.ROOT_CATEGORY, platform, config.DELETE_CATEGORY])), dtype=np.int64)),
+            )
+
+    def __len__(self) -> int:
+        return len(self.id)
+
+    def conflicts(self):
+        """Indices of the valid rows on the platform that want both an update and a delete"""
+        return np.flatnonzero(self.valid & self.on_platform & self.update & self.delete).tolist()
+
+    def operations(self):
+        """The operation for each row, by the rules of IMatchImage.decide_operation()"""
+        operations = np.full(len(self), IMatchImage.OP_NONE, dtype=np.int8)
+        operations[~self.on_platform] = IMatchImage.OP_ADD
+        operations[self.on_platform & self.update] = IMatchImage.OP_UPDATE
+        operations[self.on_platform & self.delete] = IMatchImage.OP_DELETE
+        operations[self.on_platform & self.update & self.delete] = IMatchImage.OP_INVALID
+        operations[~self.valid] = IMatchImage.OP_INVALID
+        return operations
@@ -1,9 +1,9 @@
-from datetime import datetime
-import sys
 import logging
 
 import IMatchAPI as im
 import config
+import keyword_rules
+import validation
 
 logging.getLogger('urllib3').setLevel(logging.INFO) # Don't want this debug level to cloud ours
 
@@ -16,147 +16,95 @@ class IMatchImage():
     OP_ADD = 1
     OP_UPDATE = 2
     OP_DELETE = 3
-
-    def __init__(self, id, controller) -> None:
-        self.id = id
+    CONFLICT_ERROR = f"Conflicting instructions. Images is in both {config.DELETE_CATEGORY} and {config.UPDATE_CATEGORY} categories."
+
+    # Every image gathered lives for the whole run, so instances are slotted rather than
+    # carrying a __dict__ each. Subclasses must declare __slots__ for anything they add.
+    # Only what is particular to the platform is held here. What IMatch holds for the file
+    # (filename, size, master_id, title, categories...) is read through to its shared record.
+    __slots__ = (
+        'id', 'record', 'errors', '_controller', 'operation', 'keywords',
+        'validated', 'on_platform',
+        )
+
+    # Checks an image must pass to be posted. Platforms add their own (see validation.py)
+    VALIDATION_RULES = validation.BASE_RULES
+
+    def __init__(self, record, controller) -> None:
+        self.id = record.id
+        self.record = record
         self.errors = []    # hold any errors raised during the process
+        self.validated = False
+        self.on_platform = None     # Only looked up for valid images
         self.controller = controller
         self.controller.register_image(self)
-        
-        # -----------------------------------------------------------------------------
-        # Now begins the process of collating the information to be posted alongside 
-        # the image itself. This is the information we want from the version to be be 
-        # posted, and later the master. Certain camera and shooting information is not
-        # propogated through the versions, so we will need to walk back up the version
-        # > master tree to obtain it.
-        params = {
-            "fields"           : "datetime,filename,name,size",
-            }
-        
-        image_info = im.IMatchAPI.get_file_metadata([self.id], params=params)[0]
-        try:
-            for attribute in image_info.keys():
-                # fileName is a special case. Ask for filename, get fileName in results
-                match attribute:
-                    case "fileName":
-                        setattr(self, 'filename', image_info[attribute])
-                    case "dateTime":
-                        date_time = datetime.strptime(image_info[attribute],'%Y-%m-%dT%H:%M:%S')
-                        setattr(self, "date_time", date_time)  
-                    case other:      
-                        setattr(self, attribute, image_info[attribute])  
-        except KeyError:
-            logging.error(f"Attribute {attribute} not returned from get_file_metadata() call")
-            sys.exit(1)
-
-        # Now grab the information from the master. This also protects us if the
-        # metadata has not yet been propogated.
-        master_params = {
-            "fields" : "", # Setting to "" stops retrieval of more than we need
-            "tagtitle" : "title",
-            "tagdescription" : "description",
-            "taghierarchical_keywords" : "hierarchicalkeywords",
-            "varaperture" : "{File.MD.aperture}",
-            "varfocal_length" : "{File.MD.focallength|value:formatted}",
-            "varheadline" : "{File.MD.headline}",
-            "variso" : "{File.MD.iso|value:formatted}", 
-            "varlens" : "{File.MD.lens}",
-            "varmodel" : "{File.MD.model}",
-            "varshutter_speed" : "{File.MD.shutterspeed|value:formatted}"   
-            }
 
-        self.master_id = im.IMatchAPI.get_master_id(self.id)
-        if self.master_id == None:
-            # We are the master, use original id
-            self.master_id = id
-        image_info = im.IMatchAPI.get_file_metadata([self.master_id],master_params)[0]
-        try:
-            for attribute in image_info.keys():
-                setattr(self, attribute, image_info[attribute])  # remove prefix for our purposes
-        except KeyError:
-            logging.error(f"Attribute {attribute} not returned from get_file_metadata() call")
-            sys.exit(1)
-        
-        # Retrieve the list of categories the image belongs to.
-        self.categories = im.IMatchAPI.get_file_categories([self.id], params={
-            'fields' : 'path,description'}
-            )[self.id]
-        
-        # Set the operation for this file.
+        # The operation is decided when the controller classifies the image
         self.operation = IMatchImage.OP_NONE
         if self.is_valid:
-            if not self.is_on_platform:
-                self.operation = IMatchImage.OP_ADD
-            else:
-                # Check collections for overriding instructions
-                if self.wants_update and self.wants_delete:
-                    # We have conflicting instructions. 
-                    self.errors.append(f"Conflicting instructions. Images is in both {IMatchImage.config.DELETE_CATEGORY} and IMatchImage.config.UPDATE_CATEGORY categories.")
-                    self.operation = IMatchImage.OP_INVALID
-                else:
-                    if self.wants_update:
-                        self.operation = IMatchImage.OP_UPDATE
-                    if self.wants_delete:
-                        self.operation = IMatchImage.OP_DELETE
-        else:
-            self.operation = IMatchImage.OP_INVALID
+            self.on_platform = self.is_on_platform
+
+    def __getattr__(self, name):
+        # Only called for what the image doesn't hold itself, which is the file's record
+        if name == 'record':
+            raise AttributeError(name)
+        return getattr(self.record, name)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, IMatchImage):
+            return NotImplemented
+        return self.id == other.id and type(self) is type(other)
+
+    def __hash__(self) -> int:
+        return hash(self.id)
 
     def __repr__(self) -> str:
-        return vars(self)
+        return f"{type(self).__name__}(id: {self.id}, master_id: {getattr(self, 'master_id', None)}, operation: {getattr(self, 'operation', None)})"
 
     def __str__(self) -> str:
         return f"{type(self).__name__}(id: {self.id}, filename: {self.filename}, size: {self.size})"
        
+    def decide_operation(self) -> int:
+        """Set and return the operation the image needs. Large batches are decided a column at a
+        time instead, by the same rules (see image_table.py)."""
+        if not self.is_valid:
+            self.operation = IMatchImage.OP_INVALID
+        elif not self.on_platform:
+            self.operation = IMatchImage.OP_ADD
+        # Check collections for overriding instructions
+        elif self.wants_update and self.wants_delete:
+            # We have conflicting instructions. Reported once, however often the image is classified.
+            if IMatchImage.CONFLICT_ERROR not in self.errors:
+                self.errors.append(IMatchImage.CONFLICT_ERROR)
+            self.operation = IMatchImage.OP_INVALID
+        elif self.wants_update:
+            self.operation = IMatchImage.OP_UPDATE
+        elif self.wants_delete:
+            self.operation = IMatchImage.OP_DELETE
+        else:
+            self.operation = IMatchImage.OP_NONE
+        return self.operation
+
     def prepare_for_upload(self) -> None:
         """Build variables ready for uploading."""
-        self.keywords = set()  # These are the keywords to output. self.hierachy_keywords is what comes in
+        # These are the keywords to output. self.hierachy_keywords is what comes in. The rules
+        # are in config.KEYWORD_RULES and each distinct keyword is only worked out once.
+        self.keywords = set()
         for keyword in self.hierarchical_keywords:
-            splits = keyword.split("|")
-            match splits[0]:
-                case 'art':
-                    for artform in splits:
-                        self.add_keyword(artform)
-                case 'genre':
-                    # Genre is tagged with itself and with "photography appended"
-                    for genre in splits[1:]:
-                        self.keywords.add(genre)
-                        if genre != 'astrophotography':
-                            self.add_keyword(genre+"photography")
-                case 'Location':
-                    try:
-                        self.add_keyword(splits[3]) # town
-                        self.add_keyword(splits[4]) # location
-                    except IndexError:
-                        pass
-                case 'nature':
-                    for nature in splits[1:]:
-                        self.add_keyword(nature) # Add each keyword
-                case 'toys and games':
-                    for nature in splits[1:]:
-                        self.add_keyword(nature) # Add each keyword
+            self.keywords.update(keyword_rules.keyword_tags(keyword))
 
         # Add certain categories as keywords
-        for categories in self.categories:
-            splits = categories['path'].split("|")
-            match splits[0]:
-                case 'Image Characteristics':
-                    self.add_keyword(splits.pop()) # Get the leaf
+        for path in self.categories:
+            self.keywords.update(keyword_rules.category_tags(path))
 
     def add_keyword(self, keyword) -> str:
         """Ensure all keywords are added without spaces"""
-        no_spaces_keyword = keyword.replace(" ","")
-        no_ampersand_keyword = no_spaces_keyword.replace("&","-and-")
-        no_dash_keyword = no_ampersand_keyword.replace("-","")
-        self.keywords.add(no_dash_keyword)
-        return no_dash_keyword
+        normalised_keyword = keyword_rules.normalise(keyword)
+        self.keywords.add(normalised_keyword)
+        return normalised_keyword
     
     def is_image_in_category(self, search_category) -> bool:
-        found = False
-        for category in self.categories:
-            if category['path'] == search_category:
-                found = True
-                break
-        return found
+        return search_category in self.categories
 
     @property
     def is_master(self) -> bool:
@@ -220,22 +168,11 @@ class IMatchImage():
    
     @property
     def is_valid(self) -> bool:
-        for attribute in ['title', 'description']:
-            try:
-                if getattr(self, attribute).strip() == '':
-                    self.errors.append(f"missing {attribute}")
-            except AttributeError:
-                self.errors.append(f"missing {attribute}")
-        genre_ok = False
-        for keyword in self.hierarchical_keywords:
-            splits = keyword.split("|")
-            match splits[0]:
-                case 'genre':
-                    genre_ok = True
-        if not genre_ok:
-            self.errors.append(f"missing genre")
-        if self.is_master:
-            self.errors.append("is master")
+        """True if the image passes its VALIDATION_RULES and has no other errors. The rules are
+        only run the first time, so this can be asked as often as needed."""
+        if not self.validated:
+            self.errors.extend(validation.validate(self, self.VALIDATION_RULES))
+            self.validated = True
         return len(self.errors) == 0
 
     @property
@@ -261,7 +198,8 @@ class IMatchImage():
 
     @property
     def wants_update(self) -> bool:
-        return self.is_image_in_category(
+        """In the platform's update category, or edited in IMatch since it was posted (see DAEMON_UPDATE_EDITED)"""
+        return self.id in self._controller.edited_ids or self.is_image_in_category(
             im.IMatchUtility.build_category([
                 config.ROOT_CATEGORY,
                 self._controller.name,
@@ -0,0 +1,62 @@
+from functools import lru_cache
+import sys
+
+import config
+
+# Keywords are posted without spaces or dashes, and & spelled out. One translate pass does the lot.
+NORMALISE_TABLE = str.maketrans({' ' : None, '-' : None, '&' : 'and'})
+
+
+def normalise(keyword) -> str:
+    """Ensure keywords are output without spaces"""
+    return keyword.translate(NORMALISE_TABLE)
+
+
+class KeywordRule():
+    """A compiled entry from config.KEYWORD_RULES or config.CATEGORY_KEYWORD_RULES"""
+
+    __slots__ = ('levels', 'normalise', 'suffix', 'suffix_exclude')
+
+    def __init__(self, levels=(0, None), normalise=True, suffix=None, suffix_exclude=()) -> None:
+        self.levels = slice(*levels)
+        self.normalise = normalise
+        self.suffix = suffix
+        self.suffix_exclude = frozenset(suffix_exclude)
+
+    def apply(self, splits) -> frozenset:
+        tags = set()
+        for level in splits[self.levels]:
+            tags.add(normalise(level) if self.normalise else level)
+            if self.suffix is not None and level not in self.suffix_exclude:
+                tags.add(normalise(level + self.suffix))
+        return frozenset(sys.intern(tag) for tag in tags)
+
+
+def compile_rules(rules) -> dict:
+    """Turn a rules table from config into root -> KeywordRule"""
+    return {root : KeywordRule(**rule) for root, rule in rules.items()}
+
+
+KEYWORD_RULES = compile_rules(config.KEYWORD_RULES)
+CATEGORY_KEYWORD_RULES = compile_rules(config.CATEGORY_KEYWORD_RULES)
+NO_TAGS = frozenset()
+
+
+def _tags(rules, path) -> frozenset:
+    splits = path.split("|")
+    try:
+        return rules[splits[0]].apply(splits)
+    except KeyError:
+        return NO_TAGS
+
+
+@lru_cache(maxsize=config.KEYWORD_CACHE_SIZE)
+def keyword_tags(keyword) -> frozenset:
+    """The tags to post for a hierarchical keyword"""
+    return _tags(KEYWORD_RULES, keyword)
+
+
+@lru_cache(maxsize=config.KEYWORD_CACHE_SIZE)
+def category_tags(path) -> frozenset:
+    """The tags to post for an image being in the category"""
+    return _tags(CATEGORY_KEYWORD_RULES, path)
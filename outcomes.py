@@ -0,0 +1,68 @@
+import requests
+
+
+class RetryableError(Exception):
+    """A failure worth trying again later, e.g. a timeout or the server being busy. The message
+    becomes the image's error category if the retries run out, so keep it short."""
+
+
+class PermanentError(Exception):
+    """A failure that will keep happening until something is fixed, e.g. a bad group id. The
+    message becomes the image's error category, so keep it short."""
+
+
+# Operation -> what to call a failed one, e.g. "add failed"
+OPERATION_NAMES = {
+    1 : "add",
+    2 : "update",
+    3 : "delete",
+}
+
+
+def is_retryable(error) -> bool:
+    """True for failures of the connection rather than of the request itself. Platforms add their
+    own (see PlatformController.is_retryable)."""
+    if isinstance(error, RetryableError):
+        return True
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+
+class Outcome():
+    """How one operation on one image went: it succeeded, it failed but may work if tried again,
+    or it failed for good. Failed outcomes keep the call to make to try again."""
+
+    SUCCESS = 'success'
+    RETRYABLE = 'retryable'
+    PERMANENT = 'permanent'
+
+    __slots__ = ('image', 'operation', 'status', 'error', 'retry')
+
+    def __init__(self, image, operation, status=SUCCESS, error=None, retry=None) -> None:
+        self.image = image
+        self.operation = operation
+        self.status = status
+        self.error = error      # The exception, for a failure
+        self.retry = retry      # (function, args, options) to try again with commit(image, operation, function, *args, **options)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(id: {self.image.id}, operation: {self.operation}, {self.status}: {self.error!r})"
+
+    @property
+    def succeeded(self) -> bool:
+        return self.status == Outcome.SUCCESS
+
+    @property
+    def retryable(self) -> bool:
+        return self.status == Outcome.RETRYABLE
+
+    @property
+    def category(self) -> str:
+        """The error category for a failure. Our own errors name it, anything else gets e.g.
+        "add failed" so the categories stay few however the platforms word their errors."""
+        if isinstance(self.error, (RetryableError, PermanentError)):
+            return str(self.error)
+        return f"{OPERATION_NAMES.get(self.operation, 'commit')} failed"
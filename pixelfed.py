@@ -1,22 +1,33 @@
 ## Pre-requisites
 # pip3 install Mastodon.py
+import hashlib
 import sys
 import logging
+import random
+import threading
+import time
 
 import mastodon
 
 from imatch_image import IMatchImage
+from outcomes import PermanentError
 from platform_base import PlatformController
 import IMatchAPI as im
 import config
+import validation
 
 
 class PixelfedImage(IMatchImage):
 
     __MAX_SIZE = 15 * config.MB_SIZE
+    __slots__ = ('alt_text', 'full_description')
+    VALIDATION_RULES = IMatchImage.VALIDATION_RULES + (
+        validation.required('headline'),
+        validation.max_size(__MAX_SIZE),
+        )
 
-    def __init__(self, id, platform) -> None:
-        super().__init__(id, platform)
+    def __init__(self, record, platform) -> None:
+        super().__init__(record, platform)
         self.alt_text = None
 
     def prepare_for_upload(self) -> None:
@@ -40,30 +51,23 @@ class PixelfedImage(IMatchImage):
         self.full_description = "\n".join(tmp_description)
         return None
 
-    @property
-    def is_valid(self) -> bool:
-        result = super().is_valid
-        for attribute in ['headline']:
-            try:
-                if getattr(self, attribute).strip() == '':
-                    self.errors.append(f"missing {attribute}")
-            except AttributeError:
-                self.errors.append(f"missing {attribute}")
-        if self.size > PixelfedImage.__MAX_SIZE:
-            logging.error(f'{self.controller.name}: Skipping {self.name} is too large to upload: {self.size/config.MB_SIZE:2.1f} MB. Max is {PixelfedImage.__MAX_SIZE/config.MB_SIZE:2.1f} MB.')
-            print(f'{self.controller.name}: Skipping {self.name} is too large to upload: {self.size/config.MB_SIZE:2.1f} MB. Max is {PixelfedImage.__MAX_SIZE/config.MB_SIZE:2.1f} MB.')
-            self.errors.append(f"file too large")
-        return len(self.errors) == 0 and result
-
     @property
     def is_on_platform(self) -> bool:
         res = im.IMatchAPI.get_attributes("pixelfed", self.id)
         return len(res) != 0
 
 class PixelfedController(PlatformController):
-    
+
+    POST_ID_ATTRIBUTE = 'status_id'
+    ADDS_FINISH_LATER = True
+    AUDIT_PAGE_SIZE = 40    # The most Mastodon-compatible servers will return per page
+
     def __init__(self, platform) -> None:
         super().__init__(platform)
+        self._processing = {}   # media id -> (image, media) for media the server is still processing
+        self._processing_lock = threading.Lock()
+        self._checking = threading.Lock()      # Held by the thread checking on the media
+        self._visibility = None     # Set on connecting
 
     def connect(self):
         if self.api is not None:
@@ -107,85 +111,174 @@ class PixelfedController(PlatformController):
             self._visibility = im.IMatchAPI.get_application_variable("pixelfed_visibility")
             self.api = pixelfed
 
+    def idempotency_key(self, image, operation):
+        """The same key for every attempt at an operation on an image, in this run or a rerun. The
+        server returns the original status for a repeated key rather than posting a duplicate."""
+        return hashlib.sha256(f"{self.name}:{image.id}:{operation}".encode()).hexdigest()
+
+    def with_retries(self, call, image, **kwargs):
+        """Make the api call, retrying with backoff on network and server errors. Any other error,
+        or the last retry failing, is raised to the caller."""
+        for attempt in range(config.PIXELFED_RETRIES + 1):
+            try:
+                return call(**kwargs)
+            except (mastodon.MastodonNetworkError, mastodon.MastodonServerError) as me:
+                if attempt == config.PIXELFED_RETRIES:
+                    raise
+                delay = config.PIXELFED_RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1)
+                logging.warning(f"{self.name}: {call.__name__} failed for {image.filename}, retrying in {delay:.1f}s: {me}")
+                time.sleep(delay)
+
+    def is_retryable(self, error) -> bool:
+        if isinstance(error, (mastodon.MastodonNetworkError, mastodon.MastodonServerError, mastodon.MastodonRatelimitError)):
+            return True
+        return super().is_retryable(error)
+
     def commit_add(self, image):
-        """Make the api call to commit the image to the platform, and update IMatch with reference details"""
+        """Upload the media for the image. The status is posted by post_ready_media() once the server
+        has finished processing the media, so the upload thread can move on to the next image."""
+        image, media = self.upload_media(image)
+        with self._processing_lock:
+            self._processing[media['id']] = (image, media)
+        self.post_ready_media()
+
+    def upload_media(self, image):
+        """Upload the image's media without waiting for the server to process it (v2 media endpoint)"""
+        media = self.with_retries(
+            self.api.media_post,
+            image,
+            media_file = image.filename,
+            description = image.headline,
+            synchronous = False
+        )
+        return image, media
+
+    def post_ready_media(self):
+        """Check all media still processing in one pass, and post statuses for those that are ready.
+        Only one thread checks at a time; the others carry on uploading. The statuses are posted
+        after the check, so another thread can check meanwhile. A failure is collected against its
+        own image, whichever thread is checking."""
+        if not self._checking.acquire(blocking=False):
+            return
+        ready = []
         try:
-            # Prepare the image for attaching to the status. In Mastodon, "posts/toots" are all status
-            # Upload the media, then the status with the media attached. 
-            media = self.api.media_post(  
-                media_file = image.filename,
-                description= image.headline
-            )
-
-            # Create a new status with the uploaded image                   
-            status = self.api.status_post(
-                status = image.full_description,
-                media_ids = media, 
-                visibility = self._visibility
-            )
-
-            # Update the image in IMatch by adding the attributes below.
-            im.IMatchAPI().set_attributes(self.name, image.id, data = {
-                'posted' : status['created_at'].isoformat()[:10],
-                'media_id' : media['id'],
-                'status_id' : status['id'],
-                'url' : status['url']
-                })
-        except KeyError:
-            logging.error(f"{self.name}: Missed validating an image field somewhere.")
-            sys.exit()
+            with self._processing_lock:
+                processing = list(self._processing.items())
+            for media_id, (image, media) in processing:
+                if media.get('url') is None:
+                    # Still processing when we last looked. Mastodon has no call to check several at once.
+                    try:
+                        media = self.api.media(media_id)
+                    except mastodon.MastodonError as me:
+                        with self._processing_lock:
+                            del self._processing[media_id]
+                        self.failed(image, IMatchImage.OP_ADD, me, self.check_media, media, finishes=False)
+                        continue
+                    if media.get('url') is None:
+                        with self._processing_lock:
+                            self._processing[media_id] = (image, media)
+                        continue
+                with self._processing_lock:
+                    del self._processing[media_id]
+                ready.append((image, media))
+        finally:
+            self._checking.release()
+
+        for image, media in ready:
+            self.commit(image, IMatchImage.OP_ADD, self.post_status, media)
+
+    def check_media(self, image, media):
+        """Check again on uploaded media whose check failed, and put it back with the media still
+        processing to be posted. The media is on the server, so it isn't uploaded again."""
+        media = self.api.media(media['id'])
+        with self._processing_lock:
+            self._processing[media['id']] = (image, media)
+
+    def finish_adds(self):
+        """Wait for all media to finish processing and their statuses to be posted. Media still
+        processing after PIXELFED_PROCESSING_POLLS checks is reported as an error. It is not
+        uploaded again, as the server may yet process it."""
+        self.post_ready_media()
+        deadline = time.monotonic() + config.PIXELFED_PROCESSING_POLLS * config.PIXELFED_POLL_INTERVAL
+        while len(self._processing) > 0:
+            if time.monotonic() > deadline:
+                with self._processing_lock:
+                    unprocessed, self._processing = list(self._processing.values()), {}
+                for image, media in unprocessed:
+                    self.failed(image, IMatchImage.OP_ADD, PermanentError("media not processed"))
+                break
+            time.sleep(config.PIXELFED_POLL_INTERVAL)
+            self.post_ready_media()
+
+    def post_status(self, image, media):
+        """Post the status for uploaded media, and update IMatch with reference details"""
+        # Create a new status with the uploaded image. In Mastodon, "posts/toots" are all status
+        status = self.with_retries(
+            self.api.status_post,
+            image,
+            status = image.full_description,
+            media_ids = media, 
+            visibility = self._visibility,
+            idempotency_key = self.idempotency_key(image, IMatchImage.OP_ADD)
+        )
+
+        # Update the image in IMatch by adding the attributes below.
+        im.IMatchAPI().set_attributes(self.name, image.id, data = {
+            'posted' : status['created_at'].isoformat()[:10],
+            'media_id' : media['id'],
+            'status_id' : status['id'],
+            'url' : status['url']
+            })
+        print(f'{self.name}: Posted {image.filename} "{image.title}"')
+
+    def list_posts(self):
+        """Yield the id of every status on the account, a page at a time"""
+        try:
+            account = self.api.me()
+            statuses = self.api.account_statuses(account['id'], limit=PixelfedController.AUDIT_PAGE_SIZE)
+            while statuses:
+                for status in statuses:
+                    yield status['id']
+                statuses = self.api.fetch_next(statuses)
         except mastodon.MastodonAPIError as mae:
             logging.error(f"{self.name}: An API error occurred: {mae}.")
             sys.exit()
-        except Exception as e:
-            logging.error(f"{self.name}: An unexpected error occurred: {e}")
-            sys.exit()
 
-    def commit_delete(self, image):
-        """Make the api call to delete the image from the platform"""
+    def delete_post(self, post_id):
         try:
-            attributes = im.IMatchAPI().get_attributes(self.name, image.id)[0]
-            status_id = attributes['status_id']
-
-            # Update the status with new text
-            status = self.api.status_delete(
-                id = status_id,
-            )
-        except KeyError:
-            logging.error(f"{self.name}: Missed validating an image field somewhere.")
-            sys.exit()
+            self.api.status_delete(id = post_id)
         except mastodon.MastodonAPIError as mae:
             logging.error(f"{self.name}: An API error occurred: {mae}.")
             sys.exit()
-        except Exception as e:
-            logging.error(f"{self.name}: An unexpected error occurred: {e}")
-            sys.exit()
+
+    def commit_delete(self, image):
+        """Make the api call to delete the image from the platform"""
+        attributes = im.IMatchAPI().get_attributes(self.name, image.id)[0]
+        status_id = attributes['status_id']
+
+        # Update the status with new text
+        status = self.api.status_delete(
+            id = status_id,
+        )
 
     def commit_update(self, image):
         """Make the api call to update the image on the platform"""
-        try:
-            attributes = im.IMatchAPI().get_attributes(self.name, image.id)[0]
-            media_id = attributes['media_id']
-            status_id = attributes['status_id']
-
-            media = self.api.media_update(
-                id = media_id,  
-                description= image.headline
-            )
-
-            # Update the status with new text
-            status = self.api.status_update(
-                id = status_id,
-                status = image.full_description,
-                media_ids = media, 
-            )
-        except KeyError:
-            logging.error(f"{self.name}: validating an image field somewhere.")
-            sys.exit()
-        except mastodon.MastodonAPIError as mae:
-            logging.error(f"{self.name}: API error occurred: {mae}.")
-        except Exception as e:
-            logging.error(f"{self.name}: unexpected error occurred: {e}")
-            sys.exit()
+        attributes = im.IMatchAPI().get_attributes(self.name, image.id)[0]
+        media_id = attributes['media_id']
+        status_id = attributes['status_id']
+
+        media = self.api.media_update(
+            id = media_id,  
+            description= image.headline
+        )
+
+        # Update the status with new text
+        status = self.with_retries(
+            self.api.status_update,
+            image,
+            id = status_id,
+            status = image.full_description,
+            media_ids = media, 
+        )
     
 
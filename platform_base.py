@@ -1,28 +1,136 @@
+from contextlib import nullcontext
+import functools
 import logging
+import threading
+import time
 
+import requests
+
+from adaptive_uploads import AdaptiveUploader
+from cassette import Cassette
+from category_tree import CategoryTree
 import IMatchAPI as im
 from imatch_image import IMatchImage
+import outcomes
+from outcomes import Outcome
+from run_history import CountingProxy, RunHistory
+from tracing import Trace
+from work_queue import WorkQueue
 import config
 
 class PlatformController():
 
+    POST_ID_ATTRIBUTE = None    # The attribute in the platform's IMatch attribute set holding the post id
+    ADDS_FINISH_LATER = False   # True if commit_add() leaves the add to be finished by another commit (see finish_adds)
+
     def __init__(self, platform) -> None:
-        self.images = set()
-        self.images_to_add = set()
-        self.images_to_delete = set()
-        self.images_to_update = set()
-        self.invalid_images = set()
+        self.images = {}    # image id -> image. The one place images are held.
+        self.classified = {
+            IMatchImage.OP_ADD : [],
+            IMatchImage.OP_UPDATE : [],
+            IMatchImage.OP_DELETE : [],
+            IMatchImage.OP_INVALID : [],
+        }
+        self.api_calls = {}     # Calls made through the api, by name (see run_history.CountingProxy)
+        self._api_calls_lock = threading.Lock()
         self.api = None  # Holds the platform api connection once active
+        if Cassette.active is not None and Cassette.active.replaying:
+            self.api = Cassette.active.platform_api(platform)
         self.name = platform
+        self.known_ids = {}     # File id -> modified time, for the files in the platform category at the last poll (daemon mode)
+        self.edited_ids = set() # Files already posted that have been modified since the last poll (see DAEMON_UPDATE_EDITED)
+        self.shard_stats = {}   # Stats merged from shard worker processes (--shards) and finished batches (--stream)
+        self.shard_errors = {}  # image id -> (name, errors) for invalid images found by shard workers or in finished batches
+        self._queue = None      # Persistent work queue, opened on first use
+        self.uploader = AdaptiveUploader(platform)
+        self.failures = []      # Outcomes of failed operations, until retried or settled
+        self._failures_lock = threading.Lock()
+
+    @property
+    def api(self):
+        return self._api
+
+    @api.setter
+    def api(self, api):
+        # Every call through the api is counted for the run history, and recorded if recording
+        if api is not None and Cassette.active is not None and Cassette.active.recording:
+            api = Cassette.active.platform_api(self.name, api)
+        self._api = None if api is None else CountingProxy(api, self.api_calls, self._api_calls_lock)
 
     def connect(self):
         """Upload and add image to platform"""
         raise NotImplementedError("Subclasses must implement this for their specific platform.")
 
+    def poll_changes(self):
+        """Return the ids of images needing a look since the last poll. That is new files in the platform
+        category, anything in the update or delete categories, and files IMatch has modified since the
+        last poll, which are gathered and validated again. Modified covers invalid images that have been
+        put right. Edited images already posted are only updated with DAEMON_UPDATE_EDITED. The modified
+        times for the category come in one streamed request."""
+        categories = CategoryTree.snapshot()
+        current_ids = categories.direct_files(
+            im.IMatchUtility.build_category([
+                config.ROOT_CATEGORY,
+                self.name
+                ])
+            )
+        modified = {}
+        if len(current_ids) > 0:
+            for file in im.IMatchAPI.iter_file_metadata(sorted(current_ids), {'fields' : 'id,modified'}):
+                modified[file['id']] = file.get('modified')
+
+        changed_ids = set(id for id, timestamp in modified.items() if self.known_ids.get(id, '') != timestamp)
+        if config.DAEMON_UPDATE_EDITED:
+            self.edited_ids = set(id for id in changed_ids if id in self.known_ids)
+        for action_category in [config.UPDATE_CATEGORY, config.DELETE_CATEGORY]:
+            changed_ids.update(categories.files(
+                im.IMatchUtility.build_category([
+                    config.ROOT_CATEGORY,
+                    self.name,
+                    action_category
+                    ])
+                ))
+        self.known_ids = modified
+        return changed_ids & modified.keys()
+
+    def reset(self):
+        """Forget the images from the last run, keeping the platform connection"""
+        self.images.clear()
+        for bucket in self.classified.values():
+            bucket.clear()
+        self.failures = []
+
+    def merge_shard(self, result):
+        """Fold the result of a shard worker process (see share_images.run_shard) into this controller"""
+        for stat, value in result['stats'].items():
+            self.shard_stats[stat] = self.shard_stats.get(stat, 0) + value
+        self.shard_errors.update(result['errors'])
+        for call, count in result.get('api_calls', {}).items():
+            self.api_calls[call] = self.api_calls.get(call, 0) + count
+
+    def retire_images(self, images):
+        """Fold the stats and errors for a finished batch of images into the running totals, and
+        forget the images. Used when streaming (see share_images.process_streaming)."""
+        self.merge_shard({
+            'stats' : self.count_stats(len(images)),
+            'errors' : {image.id : (image.name, list(image.errors)) for image in self.invalid_images},
+            })
+        for image in images:
+            self.images.pop(image.id, None)
+        for bucket in self.classified.values():
+            bucket.clear()
+
+    def error_index(self):
+        """image id -> (name, errors) for every invalid image, including those found by shard workers"""
+        index = dict(self.shard_errors)
+        for image in self.invalid_images:
+            index[image.id] = (image.name, list(image.errors))
+        return index
+
     def register_image(self, image):
         """Register image to the list of controller's images, and connect to image"""
         image.controller = self
-        self.images.add(image)
+        self.images[image.id] = image
       
     def add_images(self):
         """Upload and add image to platform"""
@@ -34,8 +142,9 @@ class PlatformController():
 
         progress_counter = 1
         progress_end = len(self.images_to_add)
-        for image in self.images_to_add:
-            image.prepare_for_upload()
+        for image in self.queue.order(self.name, IMatchImage.OP_ADD, self.images_to_add):
+            with Trace.span('prepare_for_upload', self.name, id=image.id):
+                image.prepare_for_upload()
 
             # Prepare the image for attaching to the status. In Mastodon, "posts/toots" are all status
             # Upload the media, then the status with the media attached. 
@@ -45,27 +154,225 @@ class PlatformController():
                 continue                            
             print(f'{self.name}: Adding {image.filename} ({image.size/config.MB_SIZE:2.1f} MB) ({progress_counter}/{progress_end}) "{image.title}"')
 
-            self.commit_add(image)
+            self.queue.start(self.name, image, IMatchImage.OP_ADD)
+            self.uploader.submit(self.add_image, image)
             progress_counter += 1
 
-    def classify_images(self):
-        for image in self.images:
-            match image.operation:
-                case IMatchImage.OP_ADD:
-                    self.images_to_add.add(image)
-                case IMatchImage.OP_UPDATE:
-                    self.images_to_update.add(image)
-                case IMatchImage.OP_DELETE:
-                    self.images_to_delete.add(image)
-                case IMatchImage.OP_INVALID:
-                    self.invalid_images.add(image)
-                case other:
-                    pass
+        if not config.TESTING:
+            self.uploader.wait()
+            self.finish_adds()
+            self.retry_failures(IMatchImage.OP_ADD, self.uploader.submit, self.wait_for_adds)
+
+    def add_image(self, image):
+        """Commit one add. Runs on an upload thread."""
+        return self.commit(image, IMatchImage.OP_ADD, self.commit_add, finishes=not self.ADDS_FINISH_LATER, timed=True)
+
+    def wait_for_adds(self):
+        self.uploader.wait()
+        self.finish_adds()
+
+    def commit(self, image, operation, function, *args, finishes=True, timed=False):
+        """Run function(image, *args) for operation on image and return its Outcome. A failure is
+        collected rather than raised, so the rest of the batch carries on. The work queue marks the
+        operation done on success unless finishes is False, i.e. a later commit completes it. A timed
+        commit, and its retries, is traced and recorded in the run history with how it went."""
+        start = time.perf_counter()
+        with Trace.span(outcomes.OPERATION_NAMES[operation], self.name, id=image.id, file=image.filename) if timed else nullcontext() as span:
+            try:
+                function(image, *args)
+            except Exception as ex:
+                outcome = self.failed(image, operation, ex, function, *args, finishes=finishes, timed=timed)
+            else:
+                if finishes:
+                    self.queue.done(self.name, image, operation)
+                outcome = Outcome(image, operation)
+            if span is not None:
+                span.args['outcome'] = outcome.status
+        if timed:
+            RunHistory.current().commit(self.name, image, operation, time.perf_counter() - start, outcome.succeeded)
+        return outcome
+
+    def failed(self, image, operation, error, function=None, *args, **options):
+        """Collect a failed operation on image. If the error is retryable and a function is given,
+        the operation is tried again later with commit(image, operation, function, *args, **options)."""
+        retryable = function is not None and self.is_retryable(error)
+        outcome = Outcome(image, operation, Outcome.RETRYABLE if retryable else Outcome.PERMANENT, error, (function, args, options) if retryable else None)
+        logging.error(f"{self.name}: {outcome.category.capitalize()} for {image.filename}{' (will retry)' if retryable else ''}: {error}")
+        self.queue.failed(self.name, image, operation, error)
+        with self._failures_lock:
+            self.failures.append(outcome)
+        return outcome
+
+    def is_retryable(self, error) -> bool:
+        """True if the operation that raised error may work if tried again. Platforms add the errors
+        of their client library."""
+        return outcomes.is_retryable(error)
+
+    def retry_failures(self, operation, submit, wait):
+        """Try the retryable failures of operation again, up to COMMIT_RETRIES rounds, waiting
+        COMMIT_RETRY_BACKOFF seconds before the first and doubling after. submit(function, image, *args,
+        size=) starts a retry, size being the bytes it uploads, and wait() waits for those started. Retries within a run count as one attempt
+        in the work queue. Whatever still fails is then settled as an error."""
+        for attempt in range(config.COMMIT_RETRIES):
+            with self._failures_lock:
+                retrying = [outcome for outcome in self.failures if outcome.operation == operation and outcome.retryable]
+                self.failures = [outcome for outcome in self.failures if not (outcome.operation == operation and outcome.retryable)]
+            if len(retrying) == 0:
+                break
+            delay = config.COMMIT_RETRY_BACKOFF * 2 ** attempt
+            print(f"{self.name}: Retrying {len(retrying)} failed {outcomes.OPERATION_NAMES[operation]}s in {delay}s.")
+            time.sleep(delay)
+            for outcome in retrying:
+                function, args, options = outcome.retry
+                # Only retried uploads send the media again. Later steps (e.g. checking it was processed) don't.
+                size = outcome.image.size if function in (self.commit_add, self.commit_update) else 0
+                submit(functools.partial(self.commit, **options), outcome.image, operation, function, *args, size=size)
+            wait()
+        self.settle_failures(operation)
+
+    def settle_failures(self, operation):
+        """Move the images whose operation failed for good, or ran out of retries, to invalid_images
+        with the failure as their error. The work queue keeps the operation for the next run."""
+        with self._failures_lock:
+            settled = [outcome for outcome in self.failures if outcome.operation == operation]
+            self.failures = [outcome for outcome in self.failures if outcome.operation != operation]
+        for outcome in settled:
+            image = outcome.image
+            if image in self.classified[operation]:
+                self.classified[operation].remove(image)
+            if outcome.category not in image.errors:
+                image.errors.append(outcome.category)
+            image.operation = IMatchImage.OP_INVALID
+            if image not in self.invalid_images:
+                self.invalid_images.append(image)
+        if len(settled) > 0:
+            print(f"{self.name}: {len(settled)} {outcomes.OPERATION_NAMES[operation]}s failed. See the error categories.")
+
+    def audit(self, fix=False):
+        """Compare what IMatch records as posted against what is actually on the platform. Both sides
+        are loaded in bulk. With fix, stale IMatch attributes are removed so the images are posted
+        again on the next run, and untracked posts are deleted if config.AUDIT_DELETE_UNTRACKED."""
+        self.connect()
+
+        print( "--------------------------------------------------------------------------------------")
+        print(f"{self.name}: Auditing posts against IMatch.")
+        file_ids = sorted(CategoryTree.snapshot().files(
+            im.IMatchUtility.build_category([
+                config.ROOT_CATEGORY,
+                self.name
+                ])
+            ))
+        recorded = {}   # post id -> file id, from the IMatch attributes
+        if len(file_ids) > 0:
+            for file_id, attributes in im.IMatchAPI.get_attributes_index(self.name, file_ids).items():
+                recorded[str(attributes[self.POST_ID_ATTRIBUTE])] = file_id
+        posted = set(str(post_id) for post_id in self.list_posts())
+        print(f"{self.name}: {len(recorded)} posts recorded in IMatch, {len(posted)} found on the platform.")
+
+        missing = sorted(file_id for post_id, file_id in recorded.items() if post_id not in posted)
+        untracked = sorted(posted - recorded.keys())
+
+        for file_id in missing:
+            print(f"{self.name}: File {file_id} is recorded as posted but is not on the platform.")
+        for post_id in untracked:
+            print(f"{self.name}: Post {post_id} is on the platform but not recorded in IMatch.")
+
+        if fix and not config.TESTING:
+            if len(missing) > 0:
+                im.IMatchAPI.delete_attributes(self.name, missing)
+                print(f"{self.name}: Removed {len(missing)} stale attribute records. They will be posted on the next run.")
+            if len(untracked) > 0 and config.AUDIT_DELETE_UNTRACKED:
+                for post_id in untracked:
+                    self.delete_post(post_id)
+                print(f"{self.name}: Deleted {len(untracked)} untracked posts.")
+
+        return {
+            "missing" : missing,
+            "untracked" : untracked,
+        }
+
+    def list_posts(self):
+        """Yield the id of every post on the platform for the account"""
+        raise NotImplementedError("Subclasses must implement this for their specific platform.")
+
+    def delete_post(self, post_id):
+        """Delete a post from the platform by its platform id"""
+        raise NotImplementedError("Subclasses must implement this for their specific platform.")
+
+    @property
+    def queue(self):
+        if self._queue is None:
+            # Testing runs get a throwaway queue so they don't disturb the real one
+            self._queue = WorkQueue(":memory:" if config.TESTING else None)
+        return self._queue
+
+    def classify_images(self, images=None):
+        """Sort the images, by default all registered, by the operation each needs"""
+        if images is None:
+            images = list(self.images.values())
+        for bucket in self.classified.values():
+            bucket.clear()
+        operations = None
+        if len(images) >= config.IMAGE_TABLE_MIN_IMAGES:
+            # Large libraries are classified a column at a time. Imported here, so numpy is only
+            # loaded for a run that uses it.
+            from image_table import ImageTable
+            if ImageTable.available():
+                table = ImageTable.from_images(self.name, images, self.edited_ids)
+                for row in table.conflicts():
+                    if IMatchImage.CONFLICT_ERROR not in images[row].errors:
+                        images[row].errors.append(IMatchImage.CONFLICT_ERROR)
+                operations = table.operations().tolist()
+        if operations is None:
+            operations = [image.decide_operation() for image in images]
+        for image, operation in zip(images, operations):
+            image.operation = operation
+            try:
+                self.classified[operation].append(image)
+            except KeyError:
+                pass    # OP_NONE, nothing to do
+
+        # Record the work in the persistent queue. Work that has failed too often is set aside and
+        # reported as an error instead.
+        dead = self.queue.sync(self.name, self.images_to_add + self.images_to_update + self.images_to_delete)
+        self.queue.forget(self.name, [image.id for image in images if image.operation in (IMatchImage.OP_NONE, IMatchImage.OP_INVALID)])
+        for operation in [IMatchImage.OP_ADD, IMatchImage.OP_UPDATE, IMatchImage.OP_DELETE]:
+            for image in [image for image in self.classified[operation] if (image.id, operation) in dead]:
+                logging.warning(f"{self.name}: Skipping {image.filename}. It has failed {config.QUEUE_MAX_ATTEMPTS} times.")
+                self.classified[operation].remove(image)
+                image.errors.append("failed too many times")
+                image.operation = IMatchImage.OP_INVALID
+                self.invalid_images.append(image)
+        # Already deleted from the platform. Only IMatch is still to be updated (see finish_deletes)
+        deleted = self.queue.deleted_ids(self.name)
+        for image in [image for image in self.images_to_delete if image.id in deleted]:
+            self.images_to_delete.remove(image)
+            image.operation = IMatchImage.OP_NONE
+
+    @property
+    def images_to_add(self):
+        return self.classified[IMatchImage.OP_ADD]
+
+    @property
+    def images_to_update(self):
+        return self.classified[IMatchImage.OP_UPDATE]
+
+    @property
+    def images_to_delete(self):
+        return self.classified[IMatchImage.OP_DELETE]
+
+    @property
+    def invalid_images(self):
+        return self.classified[IMatchImage.OP_INVALID]
 
     def commit_add(self, image):
         """Make the api call to commit the image to the platform, and update IMatch with reference details"""
         raise NotImplementedError("Subclasses must implement this for their specific platform.")
 
+    def finish_adds(self):
+        """Wait for any adds commit_add() left in progress. Only needed by platforms that commit asynchronously."""
+        pass
+
     def commit_delete(self, image):
         """Make the api call to delete the image from the platform"""
         raise NotImplementedError("Subclasses must implement this for their specific platform.")
@@ -75,53 +382,82 @@ class PlatformController():
         raise NotImplementedError("Subclasses must implement this for their specific platform.")
 
     def delete_images(self):
-        """Delete images from the platform"""
+        """Delete images from the platform, then update IMatch for them"""
         if len(self.images_to_delete) == 0:
-            return  # Nothing to see here
+            self.finish_deletes()   # Any left from an earlier run
+            return
         
         if not config.TESTING:
             self.connect()
 
-        deleted_images = set()
         progress_counter = 1
         progress_end = len(self.images_to_delete)
-        for image in self.images_to_delete:
+        for image in self.queue.order(self.name, IMatchImage.OP_DELETE, self.images_to_delete):
             if config.TESTING:
                 print(f'{self.name}: **Test** Deleting ({progress_counter}/{progress_end}) "{image.title}"')
                 progress_counter += 1       
                 #continue    
             print(f'{self.name}: Deleting ({progress_counter}/{progress_end}) "{image.title}"')
 
-            self.commit_delete(image)
-            deleted_images.add(image.id)
+            self.queue.start(self.name, image, IMatchImage.OP_DELETE)
+            self.commit(image, IMatchImage.OP_DELETE, self.delete_image, finishes=False, timed=True)
             progress_counter += 1       
 
-        # Unassign all deleted images from the deleted category
-        im.IMatchAPI.unassign_category(
-            im.IMatchUtility.build_category([
-                config.ROOT_CATEGORY,
-                self.name,
-                config.DELETE_CATEGORY
-                ]), 
-            list(deleted_images)
-            )
-        im.IMatchAPI.delete_attributes(self.name,list(deleted_images))
+        # Deletes are made one at a time, so retries are too
+        self.retry_failures(IMatchImage.OP_DELETE, lambda function, image, *args, size: function(image, *args), lambda: None)
+        self.finish_deletes()
+
+    def delete_image(self, image):
+        """Delete image from the platform. IMatch is updated for all the deletes together afterwards."""
+        self.commit_delete(image)
+        self.queue.deleted(self.name, image)
+
+    def finish_deletes(self):
+        """Unassign the images deleted from the platform from the delete category and drop their
+        attributes. If IMatch can't be updated, the next run tries again without deleting them from
+        the platform again."""
+        deleted_images = sorted(self.queue.deleted_ids(self.name))
+        if len(deleted_images) == 0:
+            return
+
+        try:
+            im.IMatchAPI.unassign_category(
+                im.IMatchUtility.build_category([
+                    config.ROOT_CATEGORY,
+                    self.name,
+                    config.DELETE_CATEGORY
+                    ]), 
+                deleted_images
+                )
+            im.IMatchAPI.delete_attributes(self.name, deleted_images)
+        except (im.IMatchError, requests.exceptions.RequestException) as ex:
+            logging.error(f"{self.name}: Unable to record {len(deleted_images)} deletes in IMatch, trying again next run: {ex}")
+            return
+        self.queue.deletes_done(self.name, deleted_images)
 
-    def process_errors(self):
-        """List information about all images that are invalid and were not processed"""
-        # Clear all images from the error categories before assigning those from this run.
-        children = im.IMatchAPI().get_categories_children("|".join([config.ROOT_CATEGORY,self.name,config.ERROR_CATEGORY]))
-        for child in children:
-            if len(child['files']) > 0:
-                im.IMatchAPI().unassign_category(child['path'], child['files'])
+    def process_errors(self, image_ids=None):
+        """List information about all images that are invalid and were not processed. Only image_ids
+        are cleared from the error categories first if given (e.g. those changed since the last
+        daemon poll), so the images not looked at keep their errors."""
+        # Clear the images from the error categories before assigning those from this run.
+        clearing = None if image_ids is None else set(image_ids)
+        for child in CategoryTree.snapshot().children("|".join([config.ROOT_CATEGORY,self.name,config.ERROR_CATEGORY])):
+            files = sorted(child.files if clearing is None else clearing.intersection(child.files))
+            if len(files) > 0:
+                im.IMatchAPI().unassign_category(child.path, files)
 
-        if len(self.invalid_images) > 0:
+        # error -> ids of the images with it, so each error category is assigned in one call
+        images_by_error = {}
+        for image_id, (name, errors) in self.error_index().items():
+            for error in errors:
+                images_by_error.setdefault(error, []).append(image_id)
+        if len(images_by_error) > 0:
 
             print( "--------------------------------------------------------------------------------------")
             print(f"{self.name}: Images with errors detected and tagged 'invalid for processing'. They have been assigned to '{config.ROOT_CATEGORY}|{self.name}' error categories.")
-            for image in sorted(self.invalid_images, key=lambda x: x.name):
-                for error in image.errors:
-                    im.IMatchAPI().assign_category("|".join([config.ROOT_CATEGORY,self.name,config.ERROR_CATEGORY,error]), image.id)
+            for error, image_ids in sorted(images_by_error.items()):
+                print(f"-- {len(image_ids)} {error}")
+                im.IMatchAPI().assign_category("|".join([config.ROOT_CATEGORY,self.name,config.ERROR_CATEGORY,error]), sorted(image_ids))
 
     def summarise(self):
         """Output summary of images processed"""
@@ -130,6 +466,8 @@ class PlatformController():
         print(f"{self.name}: Summary of images processed")
         for val in stats.keys():
             print(f"-- {stats[val]} {val} images")
+        if self.uploader.summary != '':
+            print(f"-- {self.uploader.summary}")
 
     def update_images(self):
         """Update images already on the platform"""
@@ -141,37 +479,65 @@ class PlatformController():
 
         progress_counter = 1
         progress_end = len(self.images_to_update)
-        for image in self.images_to_update:
-            image.prepare_for_upload()
+        for image in self.queue.order(self.name, IMatchImage.OP_UPDATE, self.images_to_update):
+            with Trace.span('prepare_for_upload', self.name, id=image.id):
+                image.prepare_for_upload()
             if config.TESTING:
                 print(f'{self.name}: **TEST** Updating ({image.size/config.MB_SIZE:2.1f} MB) ({progress_counter}/{progress_end}) "{image.title}"')
                 progress_counter += 1       
                 continue
             print(f'{self.name}: Updating ({image.size/config.MB_SIZE:2.1f} MB) ({progress_counter}/{progress_end}) "{image.title}"')
 
-            self.commit_update(image)
+            self.queue.start(self.name, image, IMatchImage.OP_UPDATE)
+            self.uploader.submit(self.update_image, image)
+            progress_counter += 1       
 
+        if config.TESTING:
+            return
+        self.uploader.wait()
+        self.retry_failures(IMatchImage.OP_UPDATE, self.uploader.submit, self.uploader.wait)
+
+        # Unassign the updated images from the update category. Those that failed stay for next time,
+        # as do all of them if IMatch can't be updated.
+        if len(self.images_to_update) == 0:
+            return
+        try:
             im.IMatchAPI.unassign_category(
                 im.IMatchUtility.build_category([
                     config.ROOT_CATEGORY,
                     self.name,
                     config.UPDATE_CATEGORY
                     ]), 
-                image.id
+                [image.id for image in self.images_to_update]
                 )
-            progress_counter += 1       
+        except (im.IMatchError, requests.exceptions.RequestException) as ex:
+            logging.error(f"{self.name}: Unable to record {len(self.images_to_update)} updates in IMatch, they stay queued: {ex}")
+            return
+        for image in self.images_to_update:
+            self.queue.done(self.name, image, IMatchImage.OP_UPDATE)
+
+    def update_image(self, image):
+        """Commit one update. Runs on an upload thread."""
+        return self.commit(image, IMatchImage.OP_UPDATE, self.commit_update, finishes=False, timed=True)
 
     @property
     def stats(self):
+        stats = self.count_stats(len(self.images))
+        for stat, value in self.shard_stats.items():
+            stats[stat] += value
+        return stats
+
+    def count_stats(self, total):
+        """Stats for the images currently classified, out of total"""
         return {
-            "total" : len(self.images),
+            "total" : total,
             "added" : len(self.images_to_add),
             "deleted" : len(self.images_to_delete),
             "updated" : len(self.images_to_update),
             "invalid" : len(self.invalid_images),
-            "untouched" : len(self.images)
+            "untouched" : total
                         - len(self.images_to_add)
                         - len(self.images_to_delete)
                         - len(self.images_to_update)
                         - len(self.invalid_images)
-        }
\ No newline at end of file
+        }
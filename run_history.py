@@ -0,0 +1,261 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import argparse
+import sqlite3
+import threading
+import time
+
+import config
+from tracing import Trace
+
+
+class CountingProxy():
+    """Stands in for a platform api object, counting each call by its dotted name (e.g.
+    'photos.setDates') into counts. Attributes other than plain values are wrapped in turn, so
+    flickrapi's photos.upload.checkTickets style is counted as well as plain methods."""
+
+    def __init__(self, target, counts, lock, path='') -> None:
+        self._target = target
+        self._counts = counts
+        self._lock = lock
+        self._path = path
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if isinstance(value, (str, bytes, int, float, list, tuple, dict, type(None))):
+            return value
+        return CountingProxy(value, self._counts, self._lock, f"{self._path}.{name}" if self._path else name)
+
+    def __call__(self, *args, **kwargs):
+        with self._lock:
+            self._counts[self._path] = self._counts.get(self._path, 0) + 1
+        with Trace.span(self._path, 'api'):
+            return self._target(*args, **kwargs)
+
+
+class RunHistory():
+    """Appends the numbers from each run to a SQLite database: per-phase durations, per-image commit
+    latency and bytes, platform api calls and IMatch requests, and the controller stats. Nothing is
+    recorded unless a run has been started, so callers can record unconditionally."""
+
+    __current = None
+    __lock = threading.Lock()
+
+    def __init__(self, path=None) -> None:
+        self.path = config.HISTORY_DATABASE if path is None else path
+        self.recording = False
+        self.started = None
+        self.lock = threading.Lock()
+        self.measures = {}  # (platform, name) -> value, written when the run finishes
+        self.commits = []   # (platform, image id, operation, seconds, bytes, succeeded)
+
+    @classmethod
+    def current(cls):
+        """The history being recorded for this run. Does nothing until start() is called on it."""
+        with cls.__lock:
+            if cls.__current is None:
+                cls.__current = RunHistory()
+            return cls.__current
+
+    @classmethod
+    def begin_shard(cls, recording):
+        """Start a fresh history in a shard worker process, dropping whatever was inherited from the
+        parent. Its numbers go back to the parent with the shard's result (see shard_result, merge)."""
+        with cls.__lock:
+            cls.__current = RunHistory()
+            if recording:
+                cls.__current.start()
+            return cls.__current
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        with connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    id INTEGER PRIMARY KEY,
+                    started TEXT NOT NULL,
+                    seconds REAL,
+                    arguments TEXT
+                )""")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS measures (
+                    run_id INTEGER NOT NULL,
+                    platform TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    value REAL
+                )""")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS commits (
+                    run_id INTEGER NOT NULL,
+                    platform TEXT NOT NULL,
+                    image_id INTEGER NOT NULL,
+                    operation INTEGER NOT NULL,
+                    seconds REAL,
+                    bytes INTEGER,
+                    succeeded INTEGER NOT NULL DEFAULT 1
+                )""")
+            # Histories from before failed commits were recorded
+            if 'succeeded' not in [column[1] for column in connection.execute("PRAGMA table_info(commits)")]:
+                connection.execute("ALTER TABLE commits ADD COLUMN succeeded INTEGER NOT NULL DEFAULT 1")
+        return connection
+
+    def start(self, arguments='', started=None):
+        """Start recording a run. started is a time.perf_counter() value, by default now."""
+        self.started = time.perf_counter() if started is None else started
+        self.start_time = datetime.now() - timedelta(seconds=time.perf_counter() - self.started)
+        self.arguments = arguments
+        self.recording = True   # Only written when finished, so an interrupted run leaves nothing behind
+
+    def add(self, platform, name, value):
+        """Add value to a measure for the run, e.g. ('flickr', 'phase.gather.seconds', 1.2)"""
+        if not self.recording:
+            return
+        with self.lock:
+            self.measures[(platform, name)] = self.measures.get((platform, name), 0) + value
+
+    @contextmanager
+    def phase(self, platform, phase, images):
+        """Time a phase of the run over images. Repeated phases (e.g. batches when streaming) add up."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(platform, f"phase.{phase}.seconds", time.perf_counter() - start)
+            self.add(platform, f"phase.{phase}.images", images)
+
+    def commit(self, platform, image, operation, seconds, succeeded):
+        """Record one attempt at committing an image to a platform, which took seconds"""
+        if not self.recording:
+            return
+        with self.lock:
+            self.commits.append((platform, image.id, operation, seconds, image.size, succeeded))
+
+    def shard_result(self):
+        """What a shard worker process recorded, to return to the parent"""
+        with self.lock:
+            return {
+                'measures' : dict(self.measures),
+                'commits' : list(self.commits),
+            }
+
+    def merge(self, result):
+        """Add what a shard worker process recorded (see shard_result) to this run"""
+        if not self.recording:
+            return
+        with self.lock:
+            for key, value in result['measures'].items():
+                self.measures[key] = self.measures.get(key, 0) + value
+            self.commits.extend(result['commits'])
+
+    def finish(self, controllers, imatch_requests):
+        """Write the run, with the stats and api call counts of each controller"""
+        if not self.recording:
+            return
+        for controller in controllers:
+            for stat, value in controller.stats.items():
+                self.add(controller.name, f"stat.{stat}", value)
+            for call, count in controller.api_calls.items():
+                self.add(controller.name, f"calls.{call}", count)
+            self.add(controller.name, "calls", sum(controller.api_calls.values()))
+        for endpoint, count in imatch_requests.items():
+            self.add('', f"imatch.{endpoint}", count)
+        self.add('', "imatch", sum(imatch_requests.values()))
+
+        connection = self.connect()
+        with connection:
+            run_id = connection.execute(
+                "INSERT INTO runs (started, seconds, arguments) VALUES (?, ?, ?)",
+                (self.start_time.isoformat(timespec='seconds'), time.perf_counter() - self.started, self.arguments)).lastrowid
+            connection.executemany(
+                "INSERT INTO measures (run_id, platform, name, value) VALUES (?, ?, ?, ?)",
+                [(run_id, platform, name, value) for (platform, name), value in self.measures.items()])
+            connection.executemany(
+                "INSERT INTO commits (run_id, platform, image_id, operation, seconds, bytes, succeeded) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(run_id,) + commit for commit in self.commits])
+        connection.close()
+        self.recording = False
+
+
+# What the report compares between periods. Each is (label, SQL giving (platform, value) per run id).
+# All are "per something" so they stay comparable as the number of images in a run changes.
+REPORT_METRICS = [
+    ("gather time per image (s)", """
+        SELECT s.platform, s.value / i.value FROM measures s JOIN measures i USING (run_id, platform)
+        WHERE run_id = ? AND s.name = 'phase.gather.seconds' AND i.name = 'phase.gather.images' AND i.value > 0"""),
+    ("commit time per image (s)", """
+        SELECT s.platform, s.value / i.value FROM measures s JOIN measures i USING (run_id, platform)
+        WHERE run_id = ? AND s.name = 'phase.commit.seconds' AND i.name = 'phase.commit.images' AND i.value > 0"""),
+    ("upload time per MB (s)", f"""
+        SELECT platform, SUM(seconds) / (SUM(bytes) / {config.MB_SIZE}) FROM commits
+        WHERE run_id = ? AND operation = 1 AND succeeded GROUP BY platform HAVING SUM(bytes) > 0"""),
+    ("api calls per commit", """
+        SELECT platform, value / (SELECT COUNT(*) FROM commits c WHERE c.run_id = m.run_id AND c.platform = m.platform AND c.succeeded)
+        FROM measures m
+        WHERE run_id = ? AND name = 'calls'
+        AND (SELECT COUNT(*) FROM commits c WHERE c.run_id = m.run_id AND c.platform = m.platform AND c.succeeded) > 0"""),
+    ("IMatch requests per image", """
+        SELECT 'imatch', r.value / (SELECT SUM(value) FROM measures t WHERE t.run_id = r.run_id AND t.name = 'stat.total')
+        FROM measures r
+        WHERE run_id = ? AND r.platform = '' AND r.name = 'imatch'
+        AND (SELECT SUM(value) FROM measures t WHERE t.run_id = r.run_id AND t.name = 'stat.total') > 0"""),
+]
+
+
+def period_averages(connection, since, until=None):
+    """(label, platform) -> average value over the runs started in [since, until)"""
+    until = '9999' if until is None else until.isoformat(timespec='seconds')
+    run_ids = [row[0] for row in connection.execute(
+        "SELECT id FROM runs WHERE started >= ? AND started < ?",
+        (since.isoformat(timespec='seconds'), until))]
+    values = {}
+    for label, sql in REPORT_METRICS:
+        for run_id in run_ids:
+            for platform, value in connection.execute(sql, (run_id,)):
+                values.setdefault((label, platform), []).append(value)
+    return {key: sum(run_values) / len(run_values) for key, run_values in values.items()}
+
+
+def report(days=7, threshold=None, runs=10):
+    """Print the latest runs, then compare the last days against the days before them and flag
+    anything that has got worse by more than threshold (a fraction, e.g. 0.4)"""
+    threshold = config.HISTORY_REGRESSION_THRESHOLD if threshold is None else threshold
+    connection = RunHistory().connect()
+
+    print(f"Last {runs} runs")
+    print(f"{'started':20} {'seconds':>8} {'images':>7} {'added':>6} {'updated':>8} {'deleted':>8} {'invalid':>8}")
+    for run_id, started, seconds in connection.execute(
+            "SELECT id, started, seconds FROM runs ORDER BY started DESC LIMIT ?", (runs,)).fetchall()[::-1]:
+        stats = dict(connection.execute(
+            "SELECT name, SUM(value) FROM measures WHERE run_id = ? AND name LIKE 'stat.%' GROUP BY name", (run_id,)))
+        print(f"{started:20} {seconds:8.1f} " + " ".join(
+            f"{int(stats.get('stat.' + stat, 0)):>{width}}" for stat, width in [('total', 7), ('added', 6), ('updated', 8), ('deleted', 8), ('invalid', 8)]))
+
+    now = datetime.now()
+    recent = period_averages(connection, now - timedelta(days=days))
+    previous = period_averages(connection, now - timedelta(days=2 * days), now - timedelta(days=days))
+    connection.close()
+
+    print()
+    print(f"Last {days} days against the {days} days before")
+    regressions = 0
+    for (label, platform), value in sorted(recent.items()):
+        before = previous.get((label, platform))
+        if before is None or before == 0:
+            print(f"-- {platform}: {label} {value:.3f} (no earlier runs)")
+            continue
+        change = (value - before) / before
+        flag = ""
+        if change > threshold:
+            flag = "  <-- REGRESSION"
+            regressions += 1
+        print(f"-- {platform}: {label} {before:.3f} -> {value:.3f} ({change:+.0%}){flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report on the history of share_images runs.")
+    parser.add_argument('--days', type=int, default=7, help="length of the periods compared (default 7)")
+    parser.add_argument('--threshold', type=float, default=config.HISTORY_REGRESSION_THRESHOLD * 100, help="percentage worse that is flagged as a regression")
+    parser.add_argument('--runs', type=int, default=10, help="number of recent runs to list")
+    args = parser.parse_args()
+    report(days=args.days, threshold=args.threshold / 100, runs=args.runs)
@@ -1,10 +1,25 @@
+import time
+start_time = time.perf_counter()    # Before the imports, so startup cost is included in the timing
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import importlib
+import itertools
+import multiprocessing
+import os
+import queue
 import sys
 import logging
+import threading
+import zlib
 
+from cassette import Cassette
+from category_tree import CategoryTree
 import config
-import flickr
 import IMatchAPI as im
-import pixelfed
+from image_record import ImageRecord
+from run_history import RunHistory
+from tracing import Trace
 
 logging.basicConfig(
     # stream = sys.stdout,
@@ -14,35 +29,196 @@ logging.basicConfig(
 
 class Factory():
 
+    # Classes are named rather than imported so each platform's module (and its client library)
+    # is only loaded when that platform is asked for.
     platforms = {
         'flickr' : {
-            'image' : flickr.FlickrImage,
-            'controller' : flickr.FlickrController,
+            'module' : 'flickr',
+            'image' : 'FlickrImage',
+            'controller' : 'FlickrController',
         },
         'pixelfed' : {
-            'image' : pixelfed.PixelfedImage,
-            'controller' : pixelfed.PixelfedController
+            'module' : 'pixelfed',
+            'image' : 'PixelfedImage',
+            'controller' : 'PixelfedController'
         }
     }
 
     def __init__(self) -> None:
         pass
-        
+
     @classmethod
-    def build_image(cls, id, platform): 
+    def platform_class(cls, platform, kind):
+        """Import the platform's module if needed and return its image or controller class"""
         try:
-            return cls.platforms[platform.name]['image'](id, platform)
+            entry = cls.platforms[platform]
         except KeyError:
-            logging.error(f"{cls.__name__}.build(platform): '{platform.name}' is an unrecognised platform. Valid options are {cls.platforms.keys()}.")
+            logging.error(f"{cls.__name__}.build(platform): '{platform}' is an unrecognised platform. Valid options are {list(cls.platforms.keys())}.")
             sys.exit()
+        return getattr(importlib.import_module(entry['module']), entry[kind])
+        
+    @classmethod
+    def build_image(cls, id, platform): 
+        """The platform's image for file id. What IMatch holds for the file is shared by every
+        platform it is built for, so it is only fetched the first time."""
+        with Trace.span('hydrate', platform.name, id=id):
+            return cls.platform_class(platform.name, 'image')(ImageRecord.of(id), platform)
         
     @classmethod
     def build_controller(cls, platform):
+        return cls.platform_class(platform, 'controller')(platform)
+
+
+def gather_images(controller, image_ids):
+    """Gather the images for a platform from IMatch and work out what to do with each"""
+    print( "--------------------------------------------------------------------------------------")
+    print(f"{controller.name}: Gathering images from IMatch.")
+    # Images are built on several threads so their single-image IMatch requests coalesce
+    with RunHistory.current().phase(controller.name, 'gather', len(image_ids)), Trace.span('gather', controller.name):
+        with ThreadPoolExecutor(max_workers=config.GATHER_WORKERS, thread_name_prefix=f"{controller.name}-gather") as gatherers:
+            # Each file is built as soon as its record arrives in the streamed response
+            for image in gatherers.map(Trace.carry(lambda record: Factory.build_image(record.id, controller)), ImageRecord.stream(image_ids)):
+                pass
+    print(f"{controller.name}: {controller.stats['total']} images gathered from IMatch.")
+
+    controller.classify_images()
+
+
+def commit_images(controller):
+    """Add, update and delete the classified images on the platform"""
+    committing = len(controller.images_to_add) + len(controller.images_to_update) + len(controller.images_to_delete)
+    with RunHistory.current().phase(controller.name, 'commit', committing), Trace.span('commit', controller.name):
+        if 'deletes_first' in config.QUEUE_PRIORITY:
+            controller.delete_images()
+        controller.add_images()
+        controller.update_images()
+        if 'deletes_first' not in config.QUEUE_PRIORITY:
+            controller.delete_images()
+
+
+def process_images(controller, image_ids, changed_only=False):
+    """Gather the images for a platform from IMatch, then add, update and delete as needed. With
+    changed_only (a daemon poll) image_ids are only some of the platform's images, and the error
+    categories of the rest are left alone."""
+    gather_images(controller, image_ids)
+    commit_images(controller)
+    with RunHistory.current().phase(controller.name, 'errors', len(controller.invalid_images)), Trace.span('errors', controller.name):
+        controller.process_errors(image_ids if changed_only else None)
+    controller.summarise()
+
+
+def stream_images(controller, image_ids):
+    """Yield a platform's images from IMatch a batch at a time. Batches are gathered on another
+    thread, which waits when it is config.STREAM_QUEUE_DEPTH batches ahead."""
+    batches = queue.Queue(maxsize=config.STREAM_QUEUE_DEPTH)
+    failure = []
+
+    def gather():
         try:
-            return cls.platforms[platform]['controller'](platform)
-        except KeyError:
-            logging.error(f"{cls.__name__}.build(platform): '{platform.name}' is an unrecognised platform. Valid options are {cls.platforms.keys()}.")
-            sys.exit()
+            ids = iter(image_ids)
+            with ThreadPoolExecutor(max_workers=config.GATHER_WORKERS, thread_name_prefix=f"{controller.name}-gather") as gatherers:
+                while batch_ids := list(itertools.islice(ids, config.STREAM_BATCH_SIZE)):
+                    batches.put(list(gatherers.map(Trace.carry(lambda record: Factory.build_image(record.id, controller)), ImageRecord.stream(batch_ids))))
+        except BaseException as ex:
+            failure.append(ex)
+        finally:
+            batches.put(None)
+
+    threading.Thread(target=Trace.carry(gather), name=f"{controller.name}-gather", daemon=True).start()
+    while (batch := batches.get()) is not None:
+        yield batch
+    if len(failure) > 0:
+        raise failure[0]
+
+
+def process_streaming(controller, image_ids):
+    """Gather, classify and commit a platform's images a batch at a time, so posting starts
+    straight away and only a few batches of images are held at once"""
+    print( "--------------------------------------------------------------------------------------")
+    print(f"{controller.name}: Streaming images from IMatch in batches of {config.STREAM_BATCH_SIZE}.")
+    history = RunHistory.current()
+    gathering = time.perf_counter()
+    for batch in stream_images(controller, image_ids):
+        # Time spent waiting on the gather thread, which is what gathering costs a streamed run
+        history.add(controller.name, 'phase.gather.seconds', time.perf_counter() - gathering)
+        history.add(controller.name, 'phase.gather.images', len(batch))
+        controller.classify_images(batch)
+        commit_images(controller)
+        controller.retire_images(batch)
+        print(f"{controller.name}: {controller.shard_stats.get('total', 0)} images processed.")
+        gathering = time.perf_counter()
+    with history.phase(controller.name, 'errors', len(controller.shard_errors)), Trace.span('errors', controller.name):
+        controller.process_errors()
+    controller.summarise()
+
+
+def shard_of(image_id, shards):
+    """Stable shard number for an image. The same image always lands in the same shard."""
+    return zlib.crc32(str(image_id).encode()) % shards
+
+
+def run_shard(platform, shard, shards, image_ids, recording=False):
+    """Process one shard of a platform's images. Runs in its own worker process with its own
+    IMatch session and platform connection. Errors are returned for the parent to record, as are
+    the phase and commit timings if the parent is recording history. So is anything that would
+    end the worker, as a worker that exits never returns to the pool."""
+    try:
+        history = RunHistory.begin_shard(recording)
+        im.IMatchAPI()
+        controller = Factory.build_controller(platform)
+        gather_images(controller, image_ids)
+        commit_images(controller)
+    except BaseException as ex:
+        logging.exception(f"{platform}: Shard {shard + 1}/{shards} failed.")
+        return {
+            'failed' : f"{type(ex).__name__} {ex}",
+        }
+    print(f"{platform}: Shard {shard + 1}/{shards} done. {controller.stats}")
+    return {
+        'stats' : controller.stats,
+        'errors' : controller.error_index(),
+        'api_calls' : controller.api_calls,
+        'imatch_requests' : im.IMatchAPI.request_counts,
+        'history' : history.shard_result(),
+    }
+
+
+def process_sharded(controller, image_ids, shards):
+    """Split the platform's images across worker processes by stable hash of image id, then
+    merge their results into the controller"""
+    try:
+        lock = os.open(config.SHARD_LOCK_FILE, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        os.write(lock, str(os.getpid()).encode())
+        os.close(lock)
+    except FileExistsError:
+        logging.error(f"{controller.name}: Another sharded run holds {config.SHARD_LOCK_FILE}. Remove it if that run is no longer going.")
+        sys.exit(1)
+
+    try:
+        shard_ids = [[] for shard in range(shards)]
+        for image_id in image_ids:
+            shard_ids[shard_of(image_id, shards)].append(image_id)
+
+        print( "--------------------------------------------------------------------------------------")
+        print(f"{controller.name}: Processing {len(image_ids)} images in {shards} shards ({', '.join(str(len(ids)) for ids in shard_ids)}).")
+        history = RunHistory.current()
+        with multiprocessing.Pool(processes=shards) as pool:
+            with history.phase(controller.name, 'shards', len(image_ids)):
+                results = pool.starmap(run_shard, [(controller.name, shard, shards, ids, history.recording) for shard, ids in enumerate(shard_ids)])
+            for shard, result in enumerate(results):
+                if 'failed' in result:
+                    logging.error(f"{controller.name}: Shard {shard + 1}/{shards} failed ({result['failed']}). Its images are left for the next run.")
+                    continue
+                controller.merge_shard(result)
+                history.merge(result['history'])
+                for endpoint, count in result['imatch_requests'].items():
+                    im.IMatchAPI.request_counts[endpoint] = im.IMatchAPI.request_counts.get(endpoint, 0) + count
+    finally:
+        os.remove(config.SHARD_LOCK_FILE)
+
+    controller.process_errors()
+    controller.summarise()
+
           
 if __name__ == "__main__":
 
@@ -50,6 +226,22 @@ if __name__ == "__main__":
         print(f"Python version 3.10 or later required. You are running with version {sys.version_info.major}.{sys.version_info.minor}")
         sys.exit()
 
+    parser = argparse.ArgumentParser(description="Add, update and delete images on social platforms from IMatch.")
+    parser.add_argument('platforms', nargs='*', help=f"platforms to process (default all of {', '.join(Factory.platforms.keys())})")
+    parser.add_argument('--audit', action='store_true', help="compare IMatch records against the posts on each platform instead of processing images")
+    parser.add_argument('--daemon', action='store_true', help=f"keep running, processing changes every {config.DAEMON_POLL_INTERVAL}s")
+    parser.add_argument('--shards', type=int, default=1, help="split the images across this many worker processes")
+    parser.add_argument('--stream', action='store_true', help="gather and post images in batches, rather than gathering them all first")
+    parser.add_argument('--trace', metavar='FILE', help="write a Chrome trace of the run to FILE, for viewing in Perfetto or chrome://tracing")
+    parser.add_argument('--record', metavar='FILE', help="record every IMatch request and platform call to FILE")
+    parser.add_argument('--replay', metavar='FILE', help="replay a run recorded with --record, without IMatch or the platforms")
+    parser.add_argument('--requeue', action='store_true', help=f"try again operations set aside after failing {config.QUEUE_MAX_ATTEMPTS} times")
+    parser.add_argument('--fix', action='store_true', help="with --audit, clear IMatch records for posts no longer on the platform")
+    args = parser.parse_args()
+    if args.shards > 1 and (args.record is not None or args.replay is not None):
+        # Worker processes start afresh, so they would neither record nor replay
+        parser.error("--shards can't be used with --record or --replay")
+
     # Retreive the complete list of Socials files from IMatch for all known
     # platforms. Within IMatch, files are in the Socials|{platform} category
     # or subcategories.
@@ -57,30 +249,82 @@ if __name__ == "__main__":
     images = []             # main image store
     platform_controllers = set()
 
+    if args.record is not None:
+        im.IMatchAPI.transport = Cassette.start(args.record, 'record')
+    elif args.replay is not None:
+        im.IMatchAPI.transport = Cassette.start(args.replay, 'replay')
+        # Leave the real work queue alone
+        config.QUEUE_DATABASE = ":memory:"
+    if args.trace is not None:
+        Trace.start(args.trace)
+    if config.RECORD_HISTORY and not (args.audit or args.daemon):
+        RunHistory.current().start(" ".join(sys.argv[1:]), started=start_time)
+
     im.IMatchAPI()             # Perform initial connection
+    CategoryTree.snapshot()    # All the category information we need, in one go
+    logging.debug(f"Started in {time.perf_counter() - start_time:.3f}s.")
 
     # Gather all image information for the specified platforms
-    if len(sys.argv[1:]) > 0:
-        for platform in sys.argv[1:]:
+    if len(args.platforms) > 0:
+        for platform in args.platforms:
             platform_controllers.add(Factory.build_controller(platform))
     else:
         # Do the lot
         for platform in Factory.platforms.keys():
             platform_controllers.add(Factory.build_controller(platform))
 
-    for controller in platform_controllers:
-        print( "--------------------------------------------------------------------------------------")
-        print(f"{controller.name}: Gathering images from IMatch.")
-        for image_id in im.IMatchAPI.get_categories(im.IMatchUtility.build_category([config.ROOT_CATEGORY,controller.name]))['directFiles']:
-            image = Factory.build_image(image_id, controller)
-        print(f"{controller.name}: {controller.stats['total']} images gathered from IMatch.")
+    if args.requeue:
+        for controller in platform_controllers:
+            print(f"{controller.name}: {controller.queue.requeue(controller.name)} failed operations requeued.")
 
-        controller.classify_images()
-        controller.add_images()
-        controller.update_images()
-        controller.delete_images()
-        controller.process_errors()
-        controller.summarise()
+    if args.audit:
+        for controller in platform_controllers:
+            controller.audit(fix=args.fix)
+        print("--------------------------------------------------------------------------------------")
+        print(f"Done in {time.perf_counter() - start_time:.2f}s.")
+        sys.exit(0)
+
+    if args.daemon:
+        # Keep the IMatch session and platform connections open, and only look at images that
+        # have changed since the last poll.
+        print(f"Watching for changes every {config.DAEMON_POLL_INTERVAL}s. Ctrl+C to stop.")
+        try:
+            while True:
+                # Anything may have changed in IMatch since the last poll
+                im.IMatchAPI.clear_cache()
+                ImageRecord.clear()
+                try:
+                    CategoryTree.refresh()
+                    for controller in platform_controllers:
+                        # If IMatch fails part way, this poll's changes are looked at again next time
+                        known_ids = controller.known_ids
+                        try:
+                            changed_ids = controller.poll_changes()
+                            if len(changed_ids) > 0:
+                                controller.reset()
+                                with Trace.span(controller.name, 'platform'):
+                                    process_images(controller, changed_ids, changed_only=True)
+                        except im.IMatchError:
+                            controller.known_ids = known_ids
+                            raise
+                except im.IMatchError as ie:
+                    logging.error(f"{ie}. Trying again at the next poll.")
+                time.sleep(config.DAEMON_POLL_INTERVAL)
+        except KeyboardInterrupt:
+            print("Stopped watching.")
+            sys.exit(0)
+
+    for controller in platform_controllers:
+        image_ids = sorted(CategoryTree.snapshot().direct_files(
+            im.IMatchUtility.build_category([config.ROOT_CATEGORY,controller.name])
+            ))
+        with Trace.span(controller.name, 'platform'):
+            if args.shards > 1:
+                process_sharded(controller, image_ids, args.shards)
+            elif args.stream:
+                process_streaming(controller, image_ids)
+            else:
+                process_images(controller, image_ids)
 
     stats = {}
     for controller in platform_controllers:
@@ -96,8 +340,13 @@ if __name__ == "__main__":
     for val in stats.keys():
         print(f"-- {stats[val]} {val} images")
     
+    RunHistory.current().finish(platform_controllers, im.IMatchAPI.request_counts)
+
+    cache_stats = im.IMatchAPI.cache_stats()
+    logging.info(f"IMatch response cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses.")
+    logging.info(f"IMatch metadata loaded for {ImageRecord.count()} files.")
     print("--------------------------------------------------------------------------------------")
-    print("Done.")
+    print(f"Done in {time.perf_counter() - start_time:.2f}s.")
     sys.exit(0)
 
 
@@ -0,0 +1,134 @@
+from contextlib import nullcontext
+import atexit
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+
+class Span():
+    """One timed operation, recorded as a Chrome trace "complete" event when it ends. Its parent is
+    the span open around it on the same thread, or the span carried to the thread (see Trace.carry)."""
+
+    __slots__ = ('name', 'category', 'args', 'start', 'parent', 'tid')
+
+    def __init__(self, name, category, args) -> None:
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.parent = Trace.current()
+        self.tid = threading.get_ident()
+        Trace.spans().append(self)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        Trace.spans().remove(self)
+        Trace.record(self.name, self.category, self.start, end, self.args, self.parent)
+        return False
+
+
+class Trace():
+    """Collects spans for the run and writes them as Chrome trace-event JSON, for viewing in
+    Perfetto (ui.perfetto.dev) or chrome://tracing. Off unless start() is called, when span()
+    hands back a shared do-nothing context so tracing costs one attribute check."""
+
+    enabled = False
+    path = None
+    __events = []
+    __threads = set()
+    __origin = 0
+    __null_span = nullcontext()
+    __local = threading.local()     # Each thread's open spans, and the span carried to it
+    __flows = itertools.count(1)
+
+    @classmethod
+    def start(cls, path):
+        """Start tracing. The trace is written to path when the program exits."""
+        cls.path = path
+        cls.__origin = time.perf_counter_ns()
+        cls.enabled = True
+        atexit.register(cls.save)
+
+    @classmethod
+    def span(cls, name, category='', **args):
+        """Context manager timing the code it wraps, e.g. with Trace.span('upload', 'flickr', id=id):"""
+        if not cls.enabled:
+            return cls.__null_span
+        return Span(name, category, args)
+
+    @classmethod
+    def spans(cls):
+        """The spans open on this thread, innermost last"""
+        try:
+            return cls.__local.spans
+        except AttributeError:
+            cls.__local.spans = []
+            return cls.__local.spans
+
+    @classmethod
+    def current(cls):
+        """The innermost span open on this thread, else the span carried to it, else None"""
+        spans = cls.spans()
+        if len(spans) > 0:
+            return spans[-1]
+        return getattr(cls.__local, 'carried', None)
+
+    @classmethod
+    def carry(cls, function):
+        """Wrap function, about to be handed to another thread, so the spans it opens there are
+        children of the span open here, e.g. executor.submit(Trace.carry(upload), image).
+        Hands back function itself when tracing is off."""
+        if not cls.enabled:
+            return function
+        parent = cls.current()
+        if parent is None:
+            return function
+
+        def carried(*args, **kwargs):
+            cls.__local.carried = parent
+            try:
+                return function(*args, **kwargs)
+            finally:
+                cls.__local.carried = None
+        return carried
+
+    @classmethod
+    def record(cls, name, category, start, end, args, parent=None):
+        thread = threading.current_thread()
+        if thread.ident not in cls.__threads:
+            # Name the thread's track once, so upload and gather threads are easy to tell apart
+            cls.__threads.add(thread.ident)
+            cls.__events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': thread.ident, 'args': {'name': thread.name}})
+        if parent is not None:
+            args = dict(args, parent=parent.name)
+            if parent.tid != thread.ident:
+                # A flow arrow from the parent, on the thread that handed the work over, to this span
+                flow = next(cls.__flows)
+                ts = (max(start, parent.start) - cls.__origin) / 1000
+                cls.__events.append({'name': parent.name, 'cat': 'carry', 'ph': 's', 'id': flow, 'ts': ts, 'pid': os.getpid(), 'tid': parent.tid})
+                cls.__events.append({'name': parent.name, 'cat': 'carry', 'ph': 'f', 'bp': 'e', 'id': flow, 'ts': (start - cls.__origin) / 1000, 'pid': os.getpid(), 'tid': thread.ident})
+        cls.__events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': (start - cls.__origin) / 1000,    # Microseconds
+            'dur': (end - start) / 1000,
+            'pid': os.getpid(),
+            'tid': thread.ident,
+            'args': args,
+        })
+
+    @classmethod
+    def save(cls):
+        if not cls.enabled:
+            return
+        with open(cls.path, 'w') as trace_file:
+            json.dump({'traceEvents': cls.__events, 'displayTimeUnit': 'ms'}, trace_file, default=str)
+        logging.info(f"Trace of {len(cls.__events)} events written to {cls.path}.")
+        cls.enabled = False
@@ -0,0 +1,50 @@
+# Validation rules. Each image class declares the rules it must pass in VALIDATION_RULES, and
+# IMatchImage.is_valid runs them once per image. The error text becomes the image's error
+# category under Socials|{platform}|__errors.
+
+
+class Rule():
+    """A check an image must pass to be posted, and the error recorded against it if it fails"""
+
+    __slots__ = ('error', 'check')
+
+    def __init__(self, error, check) -> None:
+        self.error = error
+        self.check = check
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.error!r})"
+
+
+def required(attribute) -> Rule:
+    """The attribute is set and not blank"""
+    return Rule(f"missing {attribute}", lambda image: (getattr(image, attribute, None) or '').strip() != '')
+
+
+def keyword_under(root) -> Rule:
+    """At least one hierarchical keyword sits under root, e.g. a genre"""
+    prefix = root + "|"
+    return Rule(f"missing {root}", lambda image: any(keyword == root or keyword.startswith(prefix) for keyword in image.hierarchical_keywords))
+
+
+def not_master() -> Rule:
+    """Only versions are posted"""
+    return Rule("is master", lambda image: not image.is_master)
+
+
+def max_size(limit) -> Rule:
+    """The file is no bigger than the platform accepts"""
+    return Rule("file too large", lambda image: image.size <= limit)
+
+
+def validate(image, rules) -> list:
+    """The errors for each rule image fails, in rule order"""
+    return [rule.error for rule in rules if not rule.check(image)]
+
+
+BASE_RULES = (
+    required('title'),
+    required('description'),
+    keyword_under('genre'),
+    not_master(),
+    )
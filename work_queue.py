@@ -0,0 +1,152 @@
+from datetime import datetime
+import sqlite3
+import threading
+
+import config
+
+# Dead-lettered operations stay in the queue, and are skipped, until they are requeued (share_images.py
+# --requeue). Done operations are pruned the next time the platform's work is queued. Deletes made on
+# the platform wait as deleted until IMatch has been updated to match.
+STATUS_PENDING = 'pending'
+STATUS_DELETED = 'deleted'
+STATUS_DONE = 'done'
+STATUS_DEAD = 'dead'
+
+# How each config.QUEUE_PRIORITY entry orders the queue. OP_DELETE is 3.
+PRIORITY_ORDER = {
+    'deletes_first' : "operation = 3 DESC",
+    'smallest_first' : "size ASC",
+    'date_taken' : "date_taken ASC",
+}
+
+
+class WorkQueue():
+    """Persistent queue of platform operations (add, update, delete) kept in SQLite, so a run can be
+    resumed in the same order and operations that keep failing are set aside."""
+
+    def __init__(self, path=None) -> None:
+        self.path = config.QUEUE_DATABASE if path is None else path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS operations (
+                    platform TEXT NOT NULL,
+                    image_id INTEGER NOT NULL,
+                    operation INTEGER NOT NULL,
+                    size INTEGER,
+                    date_taken TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    queued TEXT,
+                    PRIMARY KEY (platform, image_id, operation)
+                )""")
+        self.order_by = ", ".join([PRIORITY_ORDER[priority] for priority in config.QUEUE_PRIORITY] + ["queued ASC", "image_id ASC"])
+
+    def sync(self, platform, images):
+        """Queue the operation for each image, keeping attempt counts for those already queued. Pending
+        operations for the same images that are no longer wanted are dropped. Returns the
+        (image id, operation) pairs that have been dead-lettered."""
+        now = datetime.now().isoformat()
+        with self.lock, self.connection:
+            # Nothing needs done operations once their run is over
+            self.connection.execute(
+                "DELETE FROM operations WHERE platform = ? AND status = ?",
+                (platform, STATUS_DONE))
+            for image in images:
+                self.connection.execute("""
+                    DELETE FROM operations
+                    WHERE platform = ? AND image_id = ? AND operation != ? AND status = ?""",
+                    (platform, image.id, image.operation, STATUS_PENDING))
+                self.connection.execute("""
+                    INSERT INTO operations (platform, image_id, operation, size, date_taken, queued)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (platform, image_id, operation) DO UPDATE SET
+                        size = excluded.size,
+                        date_taken = excluded.date_taken,
+                        attempts = CASE WHEN status = 'done' THEN 0 ELSE attempts END,
+                        queued = CASE WHEN status = 'done' THEN excluded.queued ELSE queued END,
+                        status = CASE WHEN status = 'done' THEN 'pending' ELSE status END""",
+                    (platform, image.id, image.operation, image.size, str(image.date_time), now))
+            self.connection.execute("""
+                UPDATE operations SET status = ?
+                WHERE platform = ? AND status = ? AND attempts >= ?""",
+                (STATUS_DEAD, platform, STATUS_PENDING, config.QUEUE_MAX_ATTEMPTS))
+            dead = self.connection.execute(
+                "SELECT image_id, operation FROM operations WHERE platform = ? AND status = ?",
+                (platform, STATUS_DEAD)).fetchall()
+        return set(dead)
+
+    def requeue(self, platform, image_ids=None) -> int:
+        """Give dead-lettered operations, for image_ids or all of them, a fresh set of attempts.
+        Returns the number requeued."""
+        with self.lock, self.connection:
+            if image_ids is None:
+                return self.connection.execute(
+                    "UPDATE operations SET status = ?, attempts = 0 WHERE platform = ? AND status = ?",
+                    (STATUS_PENDING, platform, STATUS_DEAD)).rowcount
+            return self.connection.executemany(
+                "UPDATE operations SET status = ?, attempts = 0 WHERE platform = ? AND image_id = ? AND status = ?",
+                [(STATUS_PENDING, platform, image_id, STATUS_DEAD) for image_id in image_ids]).rowcount
+
+    def forget(self, platform, image_ids):
+        """Drop pending operations for images that no longer need anything doing"""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "DELETE FROM operations WHERE platform = ? AND image_id = ? AND status = ?",
+                [(platform, image_id, STATUS_PENDING) for image_id in image_ids])
+
+    def order(self, platform, operation, images):
+        """Return images in the order their pending operation should be done"""
+        by_id = {image.id : image for image in images}
+        with self.lock:
+            rows = self.connection.execute(f"""
+                SELECT image_id FROM operations
+                WHERE platform = ? AND operation = ? AND status = ?
+                ORDER BY {self.order_by}""",
+                (platform, operation, STATUS_PENDING)).fetchall()
+        return [by_id[row[0]] for row in rows if row[0] in by_id]
+
+    def start(self, platform, image, operation):
+        """Count an attempt before it is made, so one that brings the run down still counts"""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE operations SET attempts = attempts + 1 WHERE platform = ? AND image_id = ? AND operation = ?",
+                (platform, image.id, operation))
+
+    def done(self, platform, image, operation):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE operations SET status = ?, last_error = NULL WHERE platform = ? AND image_id = ? AND operation = ?",
+                (STATUS_DONE, platform, image.id, operation))
+
+    def deleted(self, platform, image):
+        """Record that image has been deleted from the platform, leaving IMatch to be updated"""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE operations SET status = ?, last_error = NULL WHERE platform = ? AND image_id = ? AND operation = 3",
+                (STATUS_DELETED, platform, image.id))
+
+    def deleted_ids(self, platform) -> set:
+        """The images deleted from the platform that IMatch hasn't been updated for"""
+        with self.lock:
+            return set(row[0] for row in self.connection.execute(
+                "SELECT image_id FROM operations WHERE platform = ? AND operation = 3 AND status = ?",
+                (platform, STATUS_DELETED)))
+
+    def deletes_done(self, platform, image_ids):
+        """Mark deletes done once IMatch has been updated for them"""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE operations SET status = ? WHERE platform = ? AND image_id = ? AND operation = 3 AND status = ?",
+                [(STATUS_DONE, platform, image_id, STATUS_DELETED) for image_id in image_ids])
+
+    def failed(self, platform, image, operation, error):
+        """Record a failed attempt. Dead-letters the operation once it has had QUEUE_MAX_ATTEMPTS."""
+        with self.lock, self.connection:
+            self.connection.execute("""
+                UPDATE operations
+                SET last_error = ?, status = CASE WHEN attempts >= ? THEN ? ELSE status END
+                WHERE platform = ? AND image_id = ? AND operation = ?""",
+                (str(error), config.QUEUE_MAX_ATTEMPTS, STATUS_DEAD, platform, image.id, operation))